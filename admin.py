@@ -0,0 +1,94 @@
+import argparse
+from book_rec_app import VespaApp
+from catalog import DATA_URL, SNAPSHOT_PATH
+from embeddings import EMBEDDINGS_PATH, DocumentEmbeddingStore, OnnxEmbedder
+from neighbors import NEIGHBORS_PATH, NeighborTable
+
+
+def feed_options(args):
+    return {
+        "chunksize": args.chunksize,
+        "max_queue_size": args.max_in_flight,
+        "max_workers": args.max_workers,
+        "max_connections": args.max_connections,
+        # O snapshot do catalogo para os workers do Flask e gravado durante o feed, bloco a bloco
+        "snapshot_path": args.snapshot,
+    }
+
+
+def embedding_store(args):
+    return DocumentEmbeddingStore(args.precomputed_embeddings) if args.precomputed_embeddings else None
+
+
+def deploy(args):
+    VespaApp(source=args.source, incremental=args.incremental, embedding_store=embedding_store(args), **feed_options(args))
+
+
+def feed(args):
+    app_vespa = VespaApp.connect(args.url, args.port)
+    app_vespa.start_vespa(
+        app_vespa.app, source=args.source, incremental=args.incremental, embedding_store=embedding_store(args), **feed_options(args)
+    )
+
+
+def embed(args):
+    store = DocumentEmbeddingStore(args.output)
+    report = store.build(OnnxEmbedder(args.model_dir), source=args.source, dtype=args.dtype)
+    print(f"Embeddings: {report['computed']} computed, {report['reused']} reused")
+
+
+def neighbors(args):
+    report = NeighborTable(args.output).build(DocumentEmbeddingStore(args.embeddings), k=args.k, colbert=args.colbert)
+    print(f"Neighbors: {report['recomputed']} recomputed, {report['kept']} kept")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Administracao do Vespa do sistema de recomendacao de livros")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    deploy_parser = subparsers.add_parser("deploy", help="Implanta o pacote no Vespa (Docker) e alimenta os documentos")
+    deploy_parser.set_defaults(func=deploy)
+
+    feed_parser = subparsers.add_parser("feed", help="Alimenta um Vespa ja implantado")
+    feed_parser.add_argument("--url", default="http://localhost")
+    feed_parser.add_argument("--port", type=int, default=8080)
+    feed_parser.set_defaults(func=feed)
+
+    embed_parser = subparsers.add_parser("embed", help="Calcula offline os embeddings e5/ColBERT dos documentos")
+    embed_parser.add_argument("--source", default=DATA_URL)
+    embed_parser.add_argument("--output", default=EMBEDDINGS_PATH)
+    embed_parser.add_argument("--model-dir", default="models")
+    embed_parser.add_argument("--dtype", choices=["float32", "bfloat16"], default="bfloat16")
+    embed_parser.set_defaults(func=embed)
+
+    neighbors_parser = subparsers.add_parser("neighbors", help="Pre-calcula os K livros mais semelhantes de cada livro")
+    neighbors_parser.add_argument("--embeddings", default=EMBEDDINGS_PATH)
+    neighbors_parser.add_argument("--output", default=NEIGHBORS_PATH)
+    neighbors_parser.add_argument("-k", type=int, default=20)
+    neighbors_parser.add_argument("--colbert", action="store_true", help="Reordena os vizinhos pelo MaxSim dos tokens ColBERT")
+    neighbors_parser.set_defaults(func=neighbors)
+
+    for subparser in (deploy_parser, feed_parser):
+        subparser.add_argument("--source", default=DATA_URL)
+        subparser.add_argument("--snapshot", default=SNAPSHOT_PATH)
+        subparser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Alimenta apenas documentos novos ou alterados e remove os excluidos (usa o manifesto de hashes)",
+        )
+        subparser.add_argument("--chunksize", type=int, default=1000, help="Linhas do csv lidas por vez")
+        subparser.add_argument("--max-in-flight", type=int, default=1000, help="Maximo de documentos em voo")
+        subparser.add_argument("--max-workers", type=int, default=8)
+        subparser.add_argument("--max-connections", type=int, default=16)
+        subparser.add_argument(
+            "--precomputed-embeddings",
+            metavar="PATH",
+            help="Usa o schema com tensores pre-calculados e envia os vetores de PATH no feed (gerados por 'embed')",
+        )
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from book_rec_app import RANK_TYPES, RANK_PROFILES
+
+DEFAULT_QUERIES = [
+    "books about space travel",
+    "books about romantic love",
+    "books about wars",
+    "books about cooking",
+    "thriller books",
+]
+
+
+class EngineBackend:
+    """Chama diretamente os metodos de consulta de um VespaApp (ou outra engine com a mesma interface)."""
+
+    name = "engine"
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.timings = {}
+        engine.add_listener(self._record_timing)
+
+    def _record_timing(self, ranking, elapsed, timing, hit_count, error):
+        # Tempos reportados pelo proprio Vespa (presentation.timing), em segundos
+        with self._lock:
+            per_profile = self.timings.setdefault(ranking, {"querytime": [], "summaryfetchtime": [], "searchtime": []})
+            for name, values in per_profile.items():
+                if name in timing:
+                    values.append(timing[name])
+
+    def search(self, query, rank_type):
+        return len(self.engine.search(query, rank_type))
+
+    def engine_timings(self, rank_type):
+        with self._lock:
+            per_profile = self.timings.get(RANK_PROFILES[rank_type], {})
+            return {name: summarize(values) for name, values in per_profile.items() if values}
+
+
+class HttpBackend:
+    """Envia as buscas para o endpoint /search da aplicacao Flask."""
+
+    name = "http"
+
+    def __init__(self, url="http://localhost:5000"):
+        import requests
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def search(self, query, rank_type):
+        response = self.session.post(f"{self.url}/search", data={"query": query, "rank_type": rank_type})
+        response.raise_for_status()
+        return None
+
+    def engine_timings(self, rank_type):
+        return {}
+
+
+class StubBackend:
+    """Substituto local do Vespa: latencia simulada por tipo de ranking, para validar o harness sem backend."""
+
+    name = "stub"
+    LATENCY_MS = {
+        "bm25": 5,
+        "bm25_semantic": 12,
+        "colbert_local": 30,
+        "colbert_global": 60,
+        "hibrido_colbert_local": 35,
+        "hibrido_colbert_global": 70,
+    }
+
+    def search(self, query, rank_type):
+        time.sleep(random.expovariate(1000.0 / self.LATENCY_MS.get(rank_type, 10)))
+        return 10
+
+    def engine_timings(self, rank_type):
+        return {}
+
+
+def summarize(values):
+    # Percentis em milissegundos
+    values = np.asarray(values, dtype=float) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"mean": round(float(values.mean()), 3), "p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3)}
+
+
+def run_rank_type(backend, rank_type, queries, concurrency, warmup=1):
+    for query in queries[:warmup]:
+        backend.search(query, rank_type)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def timed(query):
+        start = time.perf_counter()
+        try:
+            backend.search(query, rank_type)
+            error = None
+        except Exception as e:
+            error = repr(e)
+        elapsed = time.perf_counter() - start
+        with lock:
+            if error is None:
+                latencies.append(elapsed)
+            else:
+                errors.append(error)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, queries))
+    wall = time.perf_counter() - start
+
+    result = {
+        "requests": len(queries),
+        "errors": len(errors),
+        "qps": round(len(latencies) / wall, 2) if wall > 0 else 0.0,
+        "latency_ms": summarize(latencies) if latencies else None,
+        "engine_timing_ms": backend.engine_timings(rank_type),
+    }
+    if errors:
+        result["sample_errors"] = errors[:5]
+    return result
+
+
+def run_benchmark(backend, queries, rank_types=tuple(RANK_TYPES), concurrency=8, repeat=1):
+    queries = list(queries) * repeat
+    return {
+        "backend": backend.name,
+        "concurrency": concurrency,
+        "queries": len(queries),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": {rank_type: run_rank_type(backend, rank_type, queries, concurrency) for rank_type in rank_types},
+    }
+
+
+def find_regressions(report, baseline, tolerance=0.2):
+    # Tipos de ranking cujo p95 ou QPS piorou mais que a tolerancia em relacao a um resultado anterior
+    regressions = []
+    for rank_type, result in report["results"].items():
+        previous = baseline.get("results", {}).get(rank_type)
+        if not previous or not previous.get("latency_ms") or not result.get("latency_ms"):
+            continue
+        if result["latency_ms"]["p95"] > previous["latency_ms"]["p95"] * (1 + tolerance):
+            regressions.append(f"{rank_type}: p95 {previous['latency_ms']['p95']} -> {result['latency_ms']['p95']} ms")
+        if result["qps"] < previous["qps"] * (1 - tolerance):
+            regressions.append(f"{rank_type}: qps {previous['qps']} -> {result['qps']}")
+    return regressions
+
+
+def make_backend(args):
+    if args.backend == "stub":
+        return StubBackend()
+    if args.backend == "http":
+        return HttpBackend(args.url)
+    from book_rec_app import create_engine
+    # Sem --use-cache o cache de resultados tem tamanho 0: toda consulta vai ao backend
+    cache_size = 1024 if args.use_cache else 0
+    if args.backend == "local":
+        return EngineBackend(create_engine("local", embeddings_path=args.embeddings, cache_size=cache_size))
+    return EngineBackend(create_engine("vespa", url=args.vespa_url, port=args.vespa_port, pool_size=max(args.concurrency, 8), cache_size=cache_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de latencia/vazao dos tipos de ranking")
+    parser.add_argument("--backend", choices=["vespa", "local", "http", "stub"], default="vespa")
+    parser.add_argument("--queries", help="Arquivo com uma consulta por linha")
+    parser.add_argument("--rank-types", nargs="+", default=list(RANK_TYPES), choices=list(RANK_TYPES))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--use-cache", action="store_true", help="Mantem o cache de resultados ligado (backends vespa e local)")
+    parser.add_argument("--url", default="http://localhost:5000", help="Aplicacao Flask (backend http)")
+    parser.add_argument("--vespa-url", default="http://localhost")
+    parser.add_argument("--vespa-port", type=int, default=8080)
+    parser.add_argument("--embeddings", default="embeddings", help="Embeddings pre-calculados (backend local)")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--baseline", help="Resultado anterior para comparar")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    report = run_benchmark(make_backend(args), queries, args.rank_types, args.concurrency, args.repeat)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for rank_type, result in report["results"].items():
+        latency = result["latency_ms"] or {}
+        print(f"{rank_type:24} qps={result['qps']:8} p50={latency.get('p50')} p95={latency.get('p95')} p99={latency.get('p99')} errors={result['errors']}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
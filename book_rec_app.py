@@ -1,4 +1,9 @@
+import asyncio
+import functools
+import itertools
+import time
 import docker
+import requests
 from vespa.io import VespaResponse, VespaQueryResponse
 from vespa.package import (
     ApplicationPackage,
@@ -13,18 +18,279 @@ from vespa.package import (
     GlobalPhaseRanking,
     Function,
     FirstPhaseRanking,
-    SecondPhaseRanking
+    SecondPhaseRanking,
+    DocumentSummary,
+    Summary,
 )
 from vespa.deployment import VespaDocker
-import pandas as pd
+from vespa.application import Vespa
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from catalog import DATA_URL, SnapshotWriter, iter_books
+from feed import FeedManifest, FeedStats, MANIFEST_PATH, content_hash
+from query_pool import QueryPool
+from query_cache import QueryCache, normalize_query
+from embedding_cache import EmbeddingCache, QueryEmbeddings
+from latency import CircuitBreaker, LatencyTracker
+from results import Hit, HitList
+from metrics import bind_trace, span
+
+QUERY_FIELDS = ['id', 'title', 'authors', 'description', 'categories']
+# Classes de resumo do schema: "short" para listas de resultados (sem a descricao, que e o grosso do
+# payload e pode vir do Catalog em memoria) e "full" para telas de detalhe
+SHORT_FIELDS = ('id', 'title', 'authors', 'categories', 'average_rating')
+FULL_FIELDS = ('id', 'title', 'authors', 'description', 'categories', 'average_rating')
+NEAREST_NEIGHBOR = "({targetHits:1000}nearestNeighbor(embedding,q))"
+DEFAULT_TARGET_HITS = 1000
+# Paginacao: os resultados sao buscados em janelas de PAGE_WINDOW hits (uma execucao do ranking serve
+# varias paginas) guardadas por PAGE_TTL segundos; MAX_OFFSET e o maxOffset padrao do Vespa
+PAGE_WINDOW = 50
+PAGE_TTL = 30.0
+MAX_OFFSET = 1000
+# Facetas: contagem de documentos por categoria sobre todo o conjunto casado (consulta + filtros)
+FACET_GROUPING = "all(group(category_list) max(20) order(-count()) each(output(count())))"
+
+# Orcamento de latencia: fracao reservada para o bm25 de reserva (sem historico dele) e teto dessa reserva;
+# o bm25 de reserva nunca recebe menos que MIN_FALLBACK_TIMEOUT (s)
+FALLBACK_SHARE = 0.25
+MAX_FALLBACK_SHARE = 0.5
+MIN_FALLBACK_TIMEOUT = 0.02
+# ladder_step do bm25 de reserva, fora da escada
+FALLBACK_STEP = -1
+# Folga (s) do cliente HTTP alem do timeout repassado ao Vespa
+CLIENT_TIMEOUT_GRACE = 0.05
+
+# Tipos de ranking da interface -> metodo de consulta
+RANK_TYPES = {
+    "bm25": "query_bm25",
+    "bm25_semantic": "query_second_phase",
+    "colbert_local": "query_colbert",
+    "colbert_global": "query_colbert_global",
+    "hibrido_colbert_local": "query_colbert_2phase",
+    "hibrido_colbert_global": "query_colbert_2phase_global",
+}
+FUSION_RANK_TYPES = ("bm25", "bm25_semantic", "colbert_local")
+# Perfil usado sozinho quando nenhum perfil da fusao responde no prazo
+FUSION_FALLBACK = "bm25"
+# Perfil de ranking do Vespa usado por cada tipo
+RANK_PROFILES = {
+    "bm25": "bm25",
+    "bm25_semantic": "bm25_semantic",
+    "colbert_local": "colbert_local",
+    "colbert_global": "colbert_global",
+    "hibrido_colbert_local": "bm25_colbert",
+    "hibrido_colbert_global": "bm25_colbert_global",
+}
+# Alternativas de cada tipo, da mais cara para a mais barata, usadas quando o orcamento de latencia nao comporta a anterior
+DEGRADATION_LADDER = {
+    "colbert_global": [
+        ("colbert_global", {}),
+        ("colbert_global", {"rerank_count": 200, "target_hits": 200}),
+        ("colbert_local", {"target_hits": 200}),
+        ("bm25_semantic", {"rerank_count": 100, "target_hits": 100}),
+    ],
+    "hibrido_colbert_global": [
+        ("hibrido_colbert_global", {}),
+        ("hibrido_colbert_global", {"rerank_count": 100, "target_hits": 200}),
+        ("hibrido_colbert_local", {"rerank_count": 100, "target_hits": 200}),
+        ("bm25_semantic", {"rerank_count": 100, "target_hits": 100}),
+    ],
+    "colbert_local": [
+        ("colbert_local", {}),
+        ("colbert_local", {"target_hits": 200}),
+        ("bm25_semantic", {"rerank_count": 100, "target_hits": 100}),
+    ],
+    "hibrido_colbert_local": [
+        ("hibrido_colbert_local", {}),
+        ("hibrido_colbert_local", {"rerank_count": 100, "target_hits": 200}),
+        ("bm25_semantic", {"rerank_count": 100, "target_hits": 100}),
+    ],
+    "bm25_semantic": [
+        ("bm25_semantic", {}),
+        ("bm25_semantic", {"rerank_count": 100, "target_hits": 100}),
+    ],
+    "bm25": [],
+}
+
+
+def split_list(value):
+    # "Author A;Author B" -> ["Author A", "Author B"]; usado para authors e categories
+    return [item.strip() for item in str(value).split(";") if item.strip()]
+
+
+def yql_string(value):
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def filter_clause(filters):
+    # filters: {"category": str ou lista, "author": str ou lista, "min_rating": float, "max_rating": float}
+    # Vira uma condicao YQL sobre os atributos fast-search; combinada com AND, restringe o conjunto
+    # casado (inclusive o nearestNeighbor) antes do ranking
+    if not filters:
+        return None
+    clauses = []
+    for key, field in (("category", "category_list"), ("author", "author_list")):
+        values = filters.get(key)
+        if values:
+            values = [values] if isinstance(values, str) else list(values)
+            clauses.append("(" + " or ".join(f"{field} contains {yql_string(value)}" for value in values) + ")")
+    if filters.get("min_rating") is not None:
+        clauses.append(f"average_rating >= {float(filters['min_rating'])}")
+    if filters.get("max_rating") is not None:
+        clauses.append(f"average_rating <= {float(filters['max_rating'])}")
+    return " and ".join(clauses) or None
+
+
+def filters_key(filters):
+    # Forma hashable dos filtros, para a chave do cache
+    if not filters:
+        return None
+    return tuple(sorted((key, tuple(value) if isinstance(value, (list, tuple)) else value) for key, value in filters.items() if value is not None))
+
+
+def parse_facets(response):
+    # Grupos de category_list na resposta do grouping: {categoria: contagem}, em ordem decrescente
+    facets = {}
+    for child in response.json.get("root", {}).get("children", []):
+        if not child.get("id", "").startswith("group:root"):
+            continue
+        for group_list in child.get("children", []):
+            for group in group_list.get("children", []):
+                facets[group["value"]] = group["fields"]["count()"]
+    return facets
+
+
+def summary_class(fields):
+    return "short" if set(fields) <= set(SHORT_FIELDS) else "full"
+
+
+def parse_hits(response, fields):
+    # Hits da resposta do Vespa direto para Hit, apenas com os campos projetados
+    hits = HitList()
+    for hit in response.hits:
+        if hit.get("id", "").startswith("group:"):
+            # Resultado do grouping (facetas), nao e um documento
+            continue
+        values = hit.get('fields', {})
+        record = {field: values.get(field) for field in fields}
+        if isinstance(record.get('description'), list):
+            record['description'] = " ".join(record['description'])
+        hits.append(Hit(relevance=hit.get('relevance'), **record))
+    return hits
+
+
+def reciprocal_rank_fusion(results, k=60, limit=10):
+    # results: {rank_type: HitList ordenado}; score(doc) = soma de 1 / (k + posicao) nas listas em que aparece
+    # O score da fusao fica em Hit.relevance
+    scores = {}
+    hits_by_id = {}
+    for hits in results.values():
+        for rank, hit in enumerate(hits, start=1):
+            scores[hit.id] = scores.get(hit.id, 0.0) + 1.0 / (k + rank)
+            hits_by_id.setdefault(hit.id, hit)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+    fused = HitList(hits_by_id[doc_id].copy() for doc_id in ranked)
+    for hit in fused:
+        hit.relevance = scores[hit.id]
+    return fused
+
+
+def unknown_rank_profile(response, profile):
+    # Erro do Vespa para um perfil que nao existe no schema implantado ("does not contain requested rank profile")
+    errors = (response.json or {}).get("root", {}).get("errors", [])
+    return any("rank profile" in str(error.get("message", "")) and profile in str(error.get("message", "")) for error in errors)
+
+
+def feed_variant(embedding_store=None):
+    # Variante gravada no manifesto do feed: embed no container, ou tensores pre-calculados de uma versao do
+    # DocumentEmbeddingStore (um 'admin.py embed' novo faz o feed incremental reenviar os vetores)
+    if embedding_store is None:
+        return "embed"
+    return f"precomputed@{embedding_store.version}"
 
-class VespaApp:
-    def __init__(self):
-        self.app = self.vespa_docker_deploy()
-        self.app = self.start_vespa(self.app)
 
-    def create_package(self):
+class VespaApp:
+    def __init__(self, app=None, source=DATA_URL, incremental=False, pool_size=25, timeout=10.0, keep_alive=True,
+                 cache_size=1024, cache_ttl=300.0, embedding_cache_path=None, embedding_store=None, **feed_options):
+        self._init_query_state(cache_size, cache_ttl, embedding_cache_path, pool_size)
+        self._embedding_profile_available = True
+        # Sem app: faz o deploy do pacote e alimenta o Vespa (uso de notebooks e do admin.py)
+        if app is None:
+            app = self.vespa_docker_deploy(precomputed_embeddings=embedding_store is not None)
+            app = self.start_vespa(app, source=source, incremental=incremental, embedding_store=embedding_store, **feed_options)
+        self.app = app
+        # Pool criado uma vez e compartilhado por todas as consultas (e threads) deste processo
+        self.pool = QueryPool(app, pool_size=pool_size, timeout=timeout, keep_alive=keep_alive)
+
+    def _init_query_state(self, cache_size, cache_ttl, embedding_cache_path, workers):
+        # Estado do lado do cliente, comum a qualquer backend de consulta
+        self.cache = QueryCache(max_size=cache_size, ttl=cache_ttl, name="results")
+        # Janelas de paginacao (inclusive as pre-buscadas), com TTL curto
+        self.pages = QueryCache(max_size=256, ttl=PAGE_TTL, name="pages")
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker()
+        self.listeners = []
+        self.embeddings = EmbeddingCache(embedding_cache_path, name="query_embeddings")
+        # Pre-busca das janelas de paginacao e preenchimento do cache de embeddings, em segundo plano
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # Executor separado e limitado para a fusao: consultas que estouram o prazo nao tomam as threads da
+        # pre-busca, e as que nem comecaram ate o prazo sao canceladas na fila
+        self.fusion_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fusion")
+
+    @classmethod
+    def connect(cls, url="http://localhost", port=8080, **pool_options):
+        # Apenas conecta a um Vespa ja implantado e alimentado, sem deploy nem feed
+        return cls(app=Vespa(url=url, port=port), **pool_options)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.fusion_executor.shutdown(wait=False, cancel_futures=True)
+        self.pool.close()
+        self.embeddings.flush()
+
+    def invalidate(self):
+        # Resultados e janelas de paginacao em cache ficam velhos depois de um feed
+        self.cache.invalidate()
+        self.pages.invalidate()
+
+    def embedding_fields(self, precomputed_embeddings=False):
+        if precomputed_embeddings:
+            # Variante com tensores calculados offline (admin.py embed) e enviados no feed: sem inferencia no container
+            return [
+                Field(
+                    name="embedding",
+                    type="tensor<float>(x[384])",
+                    indexing=["attribute", "index"],
+                    ann=HNSW(distance_metric="angular"),
+                ),
+                Field(
+                    name="colbert",
+                    type="tensor<int8>(description{}, token{}, v[16])",
+                    indexing=["attribute"],
+                ),
+            ]
+        return [
+            Field(
+                name="embedding",
+                type="tensor<float>(x[384])",
+                indexing=[
+                    'input description . " " . input categories',
+                    "embed e5",
+                    "index",
+                    "attribute",
+                ],
+                ann=HNSW(distance_metric="angular"),
+                is_document_field=False,
+            ),
+            Field(
+                name="colbert",
+                type="tensor<int8>(description{}, token{}, v[16])",
+                indexing=["input description", "embed colbert description", "attribute"],
+                is_document_field=False,
+            ),
+        ]
+
+    def create_package(self, precomputed_embeddings=False):
         package = ApplicationPackage(
             name="bookrecapp",
             schema=[
@@ -32,7 +298,8 @@ class VespaApp:
                     name="doc",
                     document=Document(
                         fields=[
-                            Field(name="id", type="string", indexing=["summary"]),
+                            # Atributo para achar um livro pelo id (ex.: ler o embedding armazenado em document_embedding)
+                            Field(name="id", type="string", indexing=["attribute", "summary"], attribute=["fast-search"]),
                             Field(name="title", type="string", indexing=["index", "summary"]),
                             Field(
                                 name="authors",
@@ -47,27 +314,19 @@ class VespaApp:
                                 bolding=False,
                             ),
                             Field(name="description", type="array<string>", indexing=["summary", "index"]),
-                            Field(
-                                name="embedding",
-                                type="tensor<float>(x[384])",
-                                indexing=[
-                                    'input description . " " . input categories',
-                                    "embed e5",
-                                    "index",
-                                    "attribute",
-                                ],
-                                ann=HNSW(distance_metric="angular"),
-                                is_document_field=False,
-                            ),
-                            Field(
-                                name="colbert",
-                                type="tensor<int8>(description{}, token{}, v[16])",
-                                indexing=["input description", "embed colbert description", "attribute"],
-                                is_document_field=False,
-                            ),
+                            # Atributos para filtros e facetas: avaliados em memoria, sem passar pelo indice de texto
+                            Field(name="category_list", type="array<string>", indexing=["attribute"], attribute=["fast-search"]),
+                            Field(name="author_list", type="array<string>", indexing=["attribute"], attribute=["fast-search"]),
+                            Field(name="average_rating", type="float", indexing=["attribute", "summary"], attribute=["fast-search"]),
+                            *self.embedding_fields(precomputed_embeddings),
                         ]
                     ),            
                     fieldsets=[FieldSet(name="default", fields=["title", "authors", "description", "categories"])],
+                    document_summaries=[
+                        DocumentSummary(name="short", summary_fields=[Summary(name=field) for field in SHORT_FIELDS]),
+                        DocumentSummary(name="full", summary_fields=[Summary(name=field) for field in FULL_FIELDS]),
+                        DocumentSummary(name="embedding", summary_fields=[Summary(name="id"), Summary(name="embedding")]),
+                    ],
                     rank_profiles=[
                         RankProfile(
                             name="bm25",
@@ -103,6 +362,16 @@ class VespaApp:
                             second_phase=SecondPhaseRanking(expression = "closeness", rerank_count=1000),
                             match_features=["bm25sum", "closeness"],
                         ),
+                        RankProfile(
+                            # Usado apenas para obter os embeddings da consulta e guarda-los no cache do cliente
+                            name="query_embedding",
+                            inputs=[
+                                ("query(q)", "tensor<float>(x[384])"),
+                                ("query(qt)", "tensor<float>(querytoken{}, v[128])"),
+                            ],
+                            first_phase="0",
+                            summary_features=["query(q)", "query(qt)"],
+                        ),
                         RankProfile(
                             name="colbert_local",
                             inputs=[
@@ -275,8 +544,8 @@ class VespaApp:
         return package
 
 
-    def vespa_docker_deploy(self):
-        package = self.create_package()
+    def vespa_docker_deploy(self, precomputed_embeddings=False):
+        package = self.create_package(precomputed_embeddings=precomputed_embeddings)
 
         vespa_docker = VespaDocker()
         app = vespa_docker.deploy(application_package=package)
@@ -284,11 +553,20 @@ class VespaApp:
         return app
 
 
-    def transform_row(self, row):
-        return {
+    def transform_row(self, row, embedding_store=None, doc_hash=None):
+        document = {
             "id": row["id"],
-            "fields": {"title": row["title"], "authors": row["authors"], "description": row["description"], "categories": row["categories"], "id": row["id"]},
+            "fields": {
+                "title": row["title"], "authors": row["authors"], "description": row["description"], "categories": row["categories"], "id": row["id"],
+                "category_list": split_list(row["categories"]),
+                "author_list": split_list(row["authors"]),
+            },
         }
+        if row.get("average_rating", "") != "":
+            document["fields"]["average_rating"] = float(row["average_rating"])
+        if embedding_store is not None:
+            document["fields"].update(embedding_store.feed_fields(row["id"], doc_hash))
+        return document
 
 
     def callback(self, response:VespaResponse, id:str):
@@ -296,157 +574,439 @@ class VespaApp:
             print(f"Error when feeding document {id}: {response.get_json()}")
 
 
-    def hits_as_df(self, response, fields):
-        records = []
-        for hit in response.hits:
-            record = {}
-            for field in fields:
-                record[field] = hit['fields'].get(field, None)  
-            records.append(record)
-        return pd.DataFrame(records)
+    def add_listener(self, listener):
+        # listener(ranking, elapsed_s, vespa_timing, hit_count, error) e chamado a cada consulta que vai ao Vespa
+        self.listeners.append(listener)
 
 
-    def start_vespa(self, app):
-        df = pd.read_csv("https://raw.githubusercontent.com/bernardovma/dados_livros/main/data.csv")
-        df['id'] = range(1, len(df) + 1)
-        df = df.fillna("")
-        df['description'] = df['description'].apply(lambda x: [x])
-        vespa_feed = df.apply(self.transform_row, axis=1).tolist()
+    def _notify(self, ranking, elapsed, timing, hit_count, error):
+        for listener in self.listeners:
+            listener(ranking, elapsed, timing, hit_count, error)
 
-        app.feed_iterable(vespa_feed, schema="doc", namespace="bookrec", callback=self.callback)
 
-        return app
+    def _embed_expressions(self, query, colbert=False):
+        # Mesmo escape do yql_string (barras invertidas antes das aspas): uma consulta terminada em \ nao escapa a aspa final
+        text = yql_string(query)
+        inputs = {"input.query(q)": f"embed(e5, {text})"}
+        if colbert:
+            inputs["input.query(qt)"] = f"embed(colbert, {text})"
+        return inputs
 
 
-    def query_bm25(self, query, limit = 10):
-        with self.app.syncio(connections=12) as session:
-                response:VespaQueryResponse = session.query(
-                    yql=f"select * from sources * where userQuery() limit {limit}",
-                    query=query,
-                    ranking="bm25",
-                    body={"input.query(q)": f"embed(e5, '{query}')"},
+    def _fetch_query_embeddings(self, query):
+        # Uma consulta barata (1 hit, ranking constante) que roda os dois embedders e devolve os tensores
+        if not self._embedding_profile_available:
+            return None
+        try:
+            response: VespaQueryResponse = self.pool.query({
+                "yql": "select id from sources * where true limit 1",
+                "ranking": "query_embedding",
+                "presentation.format.tensors": "short-value",
+                **self._embed_expressions(query, colbert=True),
+            })
+        except requests.RequestException:
+            # Falha de rede/timeout: esta consulta segue com embed() no Vespa, sem cache
+            return None
+        if not response.is_successful():
+            if unknown_rank_profile(response, "query_embedding"):
+                # Aplicacao implantada antes do perfil query_embedding existir: nao adianta tentar de novo
+                self._embedding_profile_available = False
+            return None
+        if not response.hits:
+            return None
+        features = response.hits[0]['fields']['summaryfeatures']
+        qt = features['query(qt)']
+        return QueryEmbeddings(features['query(q)'], [qt[token] for token in sorted(qt, key=int)])
+
+
+    def _embed_inputs(self, query, colbert=False):
+        # Com o embedding em cache o Vespa recebe tensores literais e nao roda os modelos. Numa falta a consulta
+        # segue com embed() (o modelo roda nela mesma, sob o timeout dela) e o cache e preenchido em segundo plano,
+        # sem uma ida a mais ao Vespa antes da consulta
+        key = normalize_query(query)
+        embeddings = self.embeddings.get(key)
+        if embeddings is None:
+            self.embeddings.fill_async(key, lambda: self._fetch_query_embeddings(query), self.executor)
+            return self._embed_expressions(query, colbert=colbert)
+        return embeddings.as_inputs(colbert=colbert)
+
+
+    def iter_feed(self, source, manifest, stats, seen_ids, pending, incremental=False, chunksize=1000, embedding_store=None, snapshot=None):
+        # Gera os documentos de forma preguicosa: apenas um bloco do csv fica em memoria por vez
+        skipped = 0
+        for chunk in iter_books(source, chunksize=chunksize):
+            seen_ids.update(chunk['id'].astype(str))
+            if snapshot is not None:
+                # O snapshot do catalogo sai da mesma leitura do csv, bloco a bloco
+                snapshot.write(chunk)
+            chunk, chunk_skipped, chunk_pending = manifest.diff(chunk, force=not incremental)
+            skipped += chunk_skipped
+            pending.update(chunk_pending)
+            for _, row in chunk.iterrows():
+                # Os embeddings pre-calculados sao identificados pelo hash do texto, nao pelo do manifesto
+                doc_hash = content_hash(row) if embedding_store is not None else None
+                row['description'] = [row['description']]
+                stats.submitted(row['id'])
+                yield self.transform_row(row, embedding_store, doc_hash)
+        stats.skipped = skipped
+
+
+    def start_vespa(self, app, source=DATA_URL, incremental=False, manifest_path=MANIFEST_PATH,
+                    chunksize=1000, max_queue_size=1000, max_workers=8, max_connections=16, embedding_store=None, snapshot_path=None):
+        # Mesmo no feed completo o manifesto e regravado, para que o proximo feed possa ser incremental
+        manifest = FeedManifest(manifest_path, variant=feed_variant(embedding_store))
+        snapshot = SnapshotWriter(snapshot_path) if snapshot_path else None
+        stats = FeedStats()
+        seen_ids = set()
+        pending = {}
+
+        def feed_callback(response:VespaResponse, id:str):
+            self.callback(response, id)
+            stats.completed(id, response.is_successful(), None if response.is_successful() else response.get_json())
+            if response.is_successful():
+                manifest.mark_fed(id, pending.pop(str(id)))
+
+        def delete_callback(response:VespaResponse, id:str):
+            self.callback(response, id)
+            stats.completed(id, response.is_successful(), None if response.is_successful() else response.get_json())
+            if response.is_successful():
+                manifest.mark_removed(id)
+
+        feed_options = {"max_queue_size": max_queue_size, "max_workers": max_workers, "max_connections": max_connections}
+        try:
+            app.feed_iterable(
+                self.iter_feed(
+                    source, manifest, stats, seen_ids, pending,
+                    incremental=incremental, chunksize=chunksize, embedding_store=embedding_store, snapshot=snapshot,
+                ),
+                schema="doc",
+                namespace="bookrec",
+                callback=feed_callback,
+                **feed_options,
+            )
+            removed = manifest.stale(seen_ids)
+            if removed:
+                def iter_deletes():
+                    for doc_id in removed:
+                        stats.submitted(doc_id)
+                        yield {"id": doc_id}
+
+                app.feed_iterable(
+                    iter_deletes(),
+                    schema="doc",
+                    namespace="bookrec",
+                    callback=delete_callback,
+                    operation_type="delete",
+                    **feed_options,
                 )
-                assert(response.is_successful())
+        except BaseException:
+            # Feed interrompido (ex.: KeyError de feed_fields): o snapshot antigo continua valendo
+            if snapshot is not None:
+                snapshot.abort()
+            raise
+        finally:
+            # Mesmo num feed interrompido, os documentos ja aceitos ficam no manifesto e o cache e invalidado
+            manifest.save()
+            self.invalidate()
+        if snapshot is not None:
+            snapshot.commit()
+        stats.finish()
+
+        summary = stats.summary()
+        updated = summary["documents"] - len(removed)
+        self.last_feed_report = {"skipped": stats.skipped, "updated": updated, "removed": len(removed), "stats": summary}
+        print(
+            f"Feed: {stats.skipped} skipped, {updated} updated, {len(removed)} removed, "
+            f"{summary['failed']} failed, {summary['docs_per_s']} docs/s, p95 {summary['latency_ms']['p95']} ms"
+        )
 
-        return self.hits_as_df(response, ['id', 'title', 'authors', 'description', 'categories'])
+        return app
 
 
-    def query_semantic(self, input_query):
-        with self.app.syncio(connections=12) as session:
-            query = input_query
-            response: VespaQueryResponse = session.query(
-                yql="select * from sources * where ({targetHits:1000}nearestNeighbor(embedding,q)) limit 10",
-                query=query,
-                ranking="semantic",
-                body={"input.query(q)": f"embed({query})"},
-            )
-            assert response.is_successful()
-        return self.hits_as_df(response, ['id', 'title', 'authors', 'description', 'categories'])
-    
-
-    def query_hybrid(self, input_query):
-        with self.app.syncio(connections=12) as session:
-            query = input_query
-            response: VespaQueryResponse = session.query(
-                yql="select * from sources * where userQuery() or ({targetHits:1000}nearestNeighbor(embedding,q)) limit 10",
-                query=query,
-                ranking="fusion",
-                body={"input.query(q)": f"embed({query})"},
-            )
-            assert response.is_successful()
-
-        return self.hits_as_df(response, ['id', 'title', 'authors', 'description', 'categories']) 
-    
-    def query_second_phase(self, input_query):
-        with self.app.syncio(connections=25) as session:
-            query = input_query
-            response: VespaQueryResponse = session.query(
-                yql="select * from sources * where userQuery() or ({targetHits:1000}nearestNeighbor(embedding,q)) limit 10",
-                query=query,
-                ranking="bm25_semantic",
-                body={"input.query(q)": f"embed(e5, '{query}')"},
-            )
-            assert response.is_successful()
-
-        return self.hits_as_df(response, ['id', 'title', 'authors', 'description', 'categories']) 
-
-    # def query_second_phase_colbert(self, input_query):
-    #     with self.app.syncio(connections=25) as session:
-    #         query = input_query
-    #         response: VespaQueryResponse = session.query(
-    #             yql="select * from sources * where userQuery() or ({targetHits:1000}nearestNeighbor(embedding,q)) limit 10",
-    #             query=query,
-    #             ranking="bm25_semantic",
-    #             body={
-    #                 "input.query(q)": f'embed(e5, "{query}")',
-    #                 "input.query(qt)": f'embed(colbert, "{query}")'
-    #             },
-    #         )
-    #         assert response.is_successful()
-
-    #     return self.hits_as_df(response, ['id', 'title', 'authors', 'description', 'categories']) 
-    
-    def query_colbert(self, input_query):
-        with self.app.syncio(connections=25) as session:
-            query = input_query
-            response: VespaQueryResponse = session.query(
-                yql="select * from sources * where userQuery() or ({targetHits:1000}nearestNeighbor(embedding,q)) limit 10",
-                query=query,
-                ranking="colbert_local",
-                body={
-                    "input.query(q)": f'embed(e5, "{query}")',
-                    "input.query(qt)": f'embed(colbert, "{query}")'
-                },
-            )
-            assert response.is_successful()
-
-        return self.hits_as_df(response, ['id', 'title', 'authors', 'description', 'categories'])
-
-
-    def query_colbert_global(self, input_query):
-        with self.app.syncio(connections=25) as session:
-            query = input_query
-            response: VespaQueryResponse = session.query(
-                yql="select * from sources * where userQuery() or ({targetHits:1000}nearestNeighbor(embedding,q)) limit 10",
-                query=query,
-                ranking="colbert_global",
-                body={
-                    "input.query(q)": f'embed(e5, "{query}")',
-                    "input.query(qt)": f'embed(colbert, "{query}")'
-                },
-            )
-            assert response.is_successful()
-
-        return self.hits_as_df(response, ['id', 'title', 'authors', 'description', 'categories'])
-    
-    def query_colbert_2phase(self, input_query):
-        with self.app.syncio(connections=25) as session:
-            query = input_query
-            response: VespaQueryResponse = session.query(
-                yql="select * from sources * where userQuery() or ({targetHits:1000}nearestNeighbor(embedding,q)) limit 10",
-                query=query,
-                ranking="bm25_colbert",
-                body={
-                    "input.query(q)": f'embed(e5, "{query}")',
-                    "input.query(qt)": f'embed(colbert, "{query}")'
-                },
-            )
-            assert response.is_successful()
-
-        return self.hits_as_df(response, ['id', 'title', 'authors', 'description', 'categories'])
-
-    def query_colbert_2phase_global(self, input_query):
-        with self.app.syncio(connections=25) as session:
-            query = input_query
-            response: VespaQueryResponse = session.query(
-                yql="select * from sources * where userQuery() or ({targetHits:1000}nearestNeighbor(embedding,q)) limit 10",
-                query=query,
-                ranking="bm25_colbert_global",
-                body={
-                    "input.query(q)": f'embed(e5, "{query}")',
-                    "input.query(qt)": f'embed(colbert, "{query}")'
-                },
-            )
-            assert response.is_successful()
+    def _execute(self, ranking, query, where, embed, limit, rerank_count, timeout, filters=None, facets=False, fields=QUERY_FIELDS, offset=0):
+        # Executa a consulta no backend e devolve (HitList, tempos reportados pelo backend)
+        # Com facets=True, hits.attrs["facets"] traz a contagem por categoria
+        with span("embed"):
+            inputs = self._embed_inputs(query, colbert=embed == "colbert") if embed else {}
+        condition = filter_clause(filters)
+        if condition:
+            where = f"({where}) and {condition}"
+        grouping = f" | {FACET_GROUPING}" if facets else ""
+        body = {
+            # No YQL, limit e a posicao final: hits [offset, offset + limit)
+            "yql": f"select {', '.join(fields)} from sources * where {where} limit {offset + limit} offset {offset}{grouping}",
+            "query": query,
+            "ranking": ranking,
+            "presentation.summary": summary_class(fields),
+            "presentation.timing": True,
+            **inputs,
+        }
+        if rerank_count is not None:
+            body["ranking.rerankCount"] = rerank_count
+        if timeout is not None:
+            body["timeout"] = f"{int(timeout * 1000)}ms"
+        with span("vespa"):
+            # O cliente espera so um pouco alem do timeout do Vespa, pelo tempo de rede
+            response: VespaQueryResponse = self.pool.query(body, timeout=None if timeout is None else timeout + CLIENT_TIMEOUT_GRACE)
+        assert response.is_successful(), response.json.get("root", {}).get("errors", response.status_code)
+        with span("parse"):
+            hits = parse_hits(response, fields)
+        if facets:
+            hits.attrs["facets"] = parse_facets(response)
+        return hits, response.json.get("timing", {})
+
 
-        return self.hits_as_df(response, ['id', 'title', 'authors', 'description', 'categories'])
\ No newline at end of file
+    def _run_query(self, ranking, query, where, embed=None, limit=10, target_hits=DEFAULT_TARGET_HITS, rerank_count=None, timeout=None,
+                   filters=None, facets=False, fields=QUERY_FIELDS, offset=0, cache=None):
+        # embed: None (so texto), "e5" (query(q)) ou "colbert" (query(q) e query(qt))
+        # target_hits/rerank_count reduzem o trabalho do nearestNeighbor e da segunda fase; timeout e repassado ao Vespa
+        # filters/facets: ver filter_clause e FACET_GROUPING; fields: projecao dos campos retornados
+        # offset: primeiro hit retornado; cache: outro QueryCache no lugar do de resultados (janelas de paginacao)
+        fields = tuple(fields)
+        where = where.replace(f"targetHits:{DEFAULT_TARGET_HITS}", f"targetHits:{target_hits}")
+
+        latency_key = (ranking, target_hits, rerank_count)
+
+        def compute():
+            start = time.perf_counter()
+            try:
+                hits, timing = self._execute(ranking, query, where, embed, limit, rerank_count, timeout, filters, facets, fields, offset)
+            except Exception as e:
+                self._notify(ranking, time.perf_counter() - start, {}, 0, repr(e))
+                # Sem isso um perfil que sempre estoura o timeout nunca teria p95 e continuaria sendo o primeiro do plano
+                self.latency.record_failure(latency_key)
+                raise
+            elapsed = time.perf_counter() - start
+            self._notify(ranking, elapsed, timing, len(hits), None)
+            self.latency.record(latency_key, elapsed)
+            return hits
+
+        # Copia: quem chama (ex.: Catalog.enrich) altera os Hit, e a entrada do cache deve ficar intacta
+        key = (normalize_query(query), ranking, offset, limit, target_hits, rerank_count, filters_key(filters), facets, fields)
+        return (cache or self.cache).get_or_compute(key, compute, timeout=timeout).copy()
+
+
+    def query_bm25(self, query, limit = 10, **options):
+        return self._run_query("bm25", query, "userQuery()", limit=limit, **options)
+
+
+    def query_semantic(self, input_query, **options):
+        return self._run_query("semantic", input_query, NEAREST_NEIGHBOR, embed="e5", **options)
+
+
+    def query_hybrid(self, input_query, **options):
+        return self._run_query("fusion", input_query, f"userQuery() or {NEAREST_NEIGHBOR}", embed="e5", **options)
+
+
+    def query_second_phase(self, input_query, **options):
+        return self._run_query("bm25_semantic", input_query, f"userQuery() or {NEAREST_NEIGHBOR}", embed="e5", **options)
+
+
+    def query_colbert(self, input_query, **options):
+        return self._run_query("colbert_local", input_query, f"userQuery() or {NEAREST_NEIGHBOR}", embed="colbert", **options)
+
+
+    def query_colbert_global(self, input_query, **options):
+        return self._run_query("colbert_global", input_query, f"userQuery() or {NEAREST_NEIGHBOR}", embed="colbert", **options)
+
+
+    def query_colbert_2phase(self, input_query, **options):
+        return self._run_query("bm25_colbert", input_query, f"userQuery() or {NEAREST_NEIGHBOR}", embed="colbert", **options)
+
+
+    def query_colbert_2phase_global(self, input_query, **options):
+        return self._run_query("bm25_colbert_global", input_query, f"userQuery() or {NEAREST_NEIGHBOR}", embed="colbert", **options)
+
+
+    def query_similar(self, vector, exclude_id=None, limit=10, target_hits=100, fields=SHORT_FIELDS):
+        # Livros mais proximos de um vetor e5 (ex.: o embedding armazenado de um livro), excluindo o proprio livro
+        response: VespaQueryResponse = self.pool.query({
+            "yql": f"select {', '.join(fields)} from sources * where ({{targetHits:{target_hits}}}nearestNeighbor(embedding,q)) limit {limit + 1}",
+            "ranking": "semantic",
+            "presentation.summary": summary_class(fields),
+            "input.query(q)": np.asarray(vector, dtype=np.float32).tolist(),
+        })
+        assert response.is_successful()
+        hits = parse_hits(response, fields)
+        return HitList([hit for hit in hits if str(hit.id) != str(exclude_id)][:limit])
+
+
+    def document_embedding(self, doc_id):
+        # Embedding e5 armazenado de um livro (campo embedding), lido do Vespa; None se o livro nao existe
+        response: VespaQueryResponse = self.pool.query({
+            "yql": f"select id from sources * where id contains {yql_string(doc_id)} limit 1",
+            "ranking": "unranked",
+            "presentation.summary": "embedding",
+            "presentation.format.tensors": "short-value",
+        })
+        assert response.is_successful(), response.json.get("root", {}).get("errors", response.status_code)
+        if not response.hits:
+            return None
+        return np.asarray(response.hits[0]["fields"]["embedding"], dtype=np.float32)
+
+
+    def search(self, query, rank_type="bm25", **options):
+        if rank_type not in RANK_TYPES:
+            raise ValueError(f"Tipo de ranking desconhecido: {rank_type}")
+        return getattr(self, RANK_TYPES[rank_type])(query, **options)
+
+
+    def search_page(self, query, rank_type="bm25", offset=0, limit=10, prefetch=True, **options):
+        # Pagina [offset, offset + limit) recortada das janelas de PAGE_WINDOW hits que a cobrem. Com prefetch,
+        # a janela da pagina seguinte e buscada em segundo plano, para a navegacao sequencial nao esperar o ranking
+        if not 0 < limit <= PAGE_WINDOW:
+            raise ValueError(f"limit deve estar entre 1 e {PAGE_WINDOW}")
+        if not 0 <= offset <= MAX_OFFSET - limit:
+            raise ValueError(f"offset deve estar entre 0 e {MAX_OFFSET - limit}")
+        first, last = offset // PAGE_WINDOW, (offset + limit - 1) // PAGE_WINDOW
+        windows = [self._window(query, rank_type, index, options) for index in range(first, last + 1)]
+        # Cada janela traz um hit a mais (o primeiro da seguinte), que so fica na ultima: diz se ha mais resultados
+        hits = HitList(itertools.chain.from_iterable(window[:PAGE_WINDOW] for window in windows[:-1]), windows[0].attrs)
+        hits.extend(windows[-1])
+        start = offset - first * PAGE_WINDOW
+        page = hits[start:start + limit]
+
+        next_offset = offset + limit
+        page.attrs.update(offset=offset, limit=limit, has_more=len(hits) > start + limit and next_offset + limit <= MAX_OFFSET)
+        page.attrs["next_offset"] = next_offset if page.attrs["has_more"] else None
+        if prefetch and page.attrs["has_more"]:
+            next_window = (next_offset + limit - 1) // PAGE_WINDOW
+            if next_window > last:
+                # Sem o timeout do orcamento: a pre-busca nao tem pressa e nao deve contar como falha do perfil.
+                # Tambem sem o trace: ela termina depois da resposta e nao faz parte do tempo da requisicao
+                prefetch_options = {key: value for key, value in options.items() if key != "timeout"}
+                self.executor.submit(self._window, query, rank_type, next_window, prefetch_options)
+        return page
+
+
+    def _window(self, query, rank_type, index, options):
+        return self.search(query, rank_type, offset=index * PAGE_WINDOW, limit=PAGE_WINDOW + 1, cache=self.pages, **options)
+
+
+    def ladder_step(self, rank_type, step):
+        # (tipo, opcoes) da alternativa step da escada de rank_type; FALLBACK_STEP e o bm25 de reserva
+        if step == FALLBACK_STEP:
+            return "bm25", {}
+        ladder = DEGRADATION_LADDER.get(rank_type, [(rank_type, {})])
+        if not 0 <= step < len(ladder):
+            raise ValueError(f"passo de degradacao invalido para {rank_type}: {step}")
+        return ladder[step]
+
+
+    def search_page_at_step(self, query, rank_type, step, offset=0, limit=10, **search_options):
+        # Outras paginas de uma busca com orcamento: a mesma alternativa escolhida na primeira, para o
+        # ranking ser o mesmo em todas as paginas
+        candidate, options = self.ladder_step(rank_type, step)
+        page = self.search_page(query, candidate, offset=offset, limit=limit, **options, **search_options)
+        page.attrs.update(rank_type=candidate, ladder_step=step, degraded=(candidate, options) != (rank_type, {}))
+        return page
+
+
+    def plan_within_budget(self, rank_type, budget):
+        # Primeira alternativa cuja latencia p95 observada cabe no orcamento (sem historico, tenta a mais cara)
+        if not self.breaker.allow():
+            return []
+        candidates = DEGRADATION_LADDER.get(rank_type, [(rank_type, {})])
+        return [
+            (candidate, options) for candidate, options in candidates
+            if (self.latency.percentile(self._latency_key(candidate, options)) or 0.0) <= budget
+        ]
+
+
+    def _latency_key(self, rank_type, options):
+        return (RANK_PROFILES[rank_type], options.get("target_hits", DEFAULT_TARGET_HITS), options.get("rerank_count"))
+
+
+    def search_within_budget(self, query, rank_type="bm25", budget=0.3, offset=0, limit=10, **search_options):
+        # budget em segundos, para a requisicao inteira: cada alternativa recebe como timeout o que resta ate o
+        # prazo, descontada a reserva do bm25. Se nenhuma alternativa cabe, o circuito esta aberto, todas falham
+        # ou o tempo acaba, cai para bm25 com o restante do orcamento
+        # O resultado e uma pagina (search_page); attrs["ladder_step"] identifica a alternativa usada, para as
+        # paginas seguintes irem por search_page_at_step. search_options (filters, facets, fields) valem para todas
+        deadline = time.perf_counter() + budget
+        reserve = self._fallback_reserve(budget)
+        ladder = DEGRADATION_LADDER.get(rank_type, [(rank_type, {})])
+        for candidate, options in self.plan_within_budget(rank_type, budget - reserve):
+            remaining = deadline - reserve - time.perf_counter()
+            if remaining <= 0:
+                break
+            start = time.perf_counter()
+            try:
+                result = self.search_page(query, candidate, offset=offset, limit=limit, timeout=remaining, **options, **search_options)
+            except Exception:
+                self.breaker.record_failure()
+                continue
+            if time.perf_counter() - start > remaining:
+                # Resposta lenta conta como falha para o circuito, mas o resultado ja obtido e usado
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            result.attrs.update(rank_type=candidate, ladder_step=ladder.index((candidate, options)),
+                                degraded=(candidate, options) != (rank_type, {}))
+            return result
+        timeout = max(deadline - time.perf_counter(), MIN_FALLBACK_TIMEOUT)
+        result = self.search_page(query, "bm25", offset=offset, limit=limit, timeout=timeout, **search_options)
+        result.attrs.update(rank_type="bm25", ladder_step=FALLBACK_STEP, degraded=rank_type != "bm25")
+        return result
+
+
+    def _fallback_reserve(self, budget):
+        # Parte do orcamento guardada para o bm25 de reserva: o p95 observado dele, ou FALLBACK_SHARE do orcamento
+        p95 = self.latency.percentile(self._latency_key("bm25", {}))
+        return min(p95 if p95 is not None else budget * FALLBACK_SHARE, budget * MAX_FALLBACK_SHARE)
+
+
+    async def search_fused_async(self, query, rank_types=FUSION_RANK_TYPES, deadline=1.0, limit=10, k=60, filters=None, facets=False, fields=QUERY_FIELDS):
+        # Cada perfil roda em paralelo (threads sobre o pool compartilhado), com o prazo como timeout; o que nao
+        # responder ate o prazo fica de fora da fusao, e o resultado e marcado como parcial
+        # As facetas (iguais em todos os perfis, pois dependem so do conjunto casado) vem do primeiro que responder
+        loop = asyncio.get_running_loop()
+        options = {"filters": filters, "facets": facets, "fields": fields}
+
+        def submit(rank_type, timeout):
+            # bind_trace: as etapas e consultas de cada perfil entram no trace da requisicao (log de consultas lentas)
+            task = bind_trace(functools.partial(self.search, query, rank_type, timeout=timeout, **options))
+            return loop.run_in_executor(self.fusion_executor, task)
+
+        # O perfil de reserva tem um prazo a mais, para servir sozinho se nenhum perfil responder a tempo
+        tasks = {submit(rank_type, deadline * 2 if rank_type == FUSION_FALLBACK else deadline): rank_type for rank_type in rank_types}
+        done, pending = await asyncio.wait(tasks, timeout=deadline)
+        results = {tasks[task]: task.result() for task in done if task.exception() is None}
+        fallback = next((task for task in pending if tasks[task] == FUSION_FALLBACK), None)
+        for task in pending:
+            if results or task is not fallback:
+                task.cancel()
+        if not results:
+            return await self._fused_fallback(fallback or submit(FUSION_FALLBACK, deadline), deadline, limit)
+        fused = reciprocal_rank_fusion({rank_type: results[rank_type] for rank_type in rank_types if rank_type in results}, k=k, limit=limit)
+        fused.attrs["profiles"] = [rank_type for rank_type in rank_types if rank_type in results]
+        fused.attrs["partial"] = len(results) < len(rank_types)
+        if facets:
+            fused.attrs["facets"] = next(iter(results.values())).attrs.get("facets", {})
+        return fused
+
+
+    async def _fused_fallback(self, task, deadline, limit):
+        # Nenhum perfil respondeu no prazo: espera mais um prazo pelo FUSION_FALLBACK e usa o resultado dele
+        try:
+            result = (await asyncio.wait_for(task, timeout=deadline))[:limit]
+            result.attrs["profiles"] = [FUSION_FALLBACK]
+        except Exception:
+            result = HitList(attrs={"profiles": []})
+        result.attrs.update(partial=True, fallback=True)
+        return result
+
+
+    def search_fused(self, query, rank_types=FUSION_RANK_TYPES, deadline=1.0, limit=10, k=60, filters=None, facets=False, fields=QUERY_FIELDS):
+        return asyncio.run(self.search_fused_async(query, rank_types=rank_types, deadline=deadline, limit=limit, k=k,
+                                                   filters=filters, facets=facets, fields=fields))
+
+
+def create_engine(kind="vespa", **options):
+    # "vespa": conecta ao Vespa implantado; "local": motor em processo (local_engine.py), sem Docker
+    if kind == "local":
+        from local_engine import LocalEngine
+        return LocalEngine(**options)
+    if kind == "vespa":
+        return VespaApp.connect(**options)
+    raise ValueError(f"Engine desconhecida: {kind}")
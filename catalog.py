@@ -0,0 +1,171 @@
+import os
+import pickle
+import threading
+import pandas as pd
+
+DATA_URL = "https://raw.githubusercontent.com/bernardovma/dados_livros/main/data.csv"
+SNAPSHOT_PATH = "catalog_snapshot.pkl"
+KEY_COLUMN = "isbn13"
+
+
+def assign_ids(df, first_position=1, seen=None, key_column=KEY_COLUMN):
+    # id do documento = isbn13 quando a fonte tem a coluna: inserir ou remover uma linha do csv nao muda
+    # o id das demais, e o feed incremental reenvia so o que mudou. Linhas sem chave ou com chave repetida
+    # (tambem entre blocos, via seen) sao descartadas. Sem a coluna, o id e a posicao da linha no csv,
+    # a partir de 1, e uma insercao no meio desloca os ids de todas as linhas seguintes
+    if key_column not in df.columns:
+        df['id'] = range(first_position, first_position + len(df))
+        return df.fillna("")
+    keys = pd.to_numeric(df[key_column], errors="coerce")
+    keep = keys.notna() & ~keys.duplicated()
+    if seen is not None:
+        keep &= ~keys.isin(seen)
+        seen.update(int(key) for key in keys[keep])
+    df = df[keep].copy()
+    df['id'] = keys[keep].astype("int64").to_numpy()
+    return df.fillna("")
+
+
+def read_books(source=DATA_URL):
+    # Mesma atribuicao de id usada em VespaApp.start_vespa (via iter_books)
+    return assign_ids(pd.read_csv(source))
+
+
+def write_snapshot(df, path=SNAPSHOT_PATH):
+    writer = SnapshotWriter(path)
+    try:
+        writer.write(df)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+
+
+def read_snapshot(path=SNAPSHOT_PATH):
+    # Um pickle por bloco gravado pelo SnapshotWriter (um so, nos snapshots antigos), concatenados na ordem
+    chunks = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                chunks.append(pickle.load(f))
+            except EOFError:
+                break
+    return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+
+class SnapshotWriter:
+    """Grava o snapshot do catalogo bloco a bloco, sem juntar o catalogo inteiro em memoria.
+
+    Cada bloco vira um pickle no mesmo arquivo temporario; commit() troca o snapshot de forma atomica,
+    entao leitores em outros processos nunca veem um arquivo pela metade. O temporario e proprio do
+    processo e da thread: workers que sobem juntos sem snapshot gravam cada um o seu, e o ultimo commit vale.
+    """
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self._tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._file = open(self._tmp_path, "wb")
+
+    def write(self, chunk):
+        pickle.dump(chunk, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def commit(self):
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def iter_books(source=DATA_URL, chunksize=1000):
+    # Le o csv em blocos, com os mesmos ids de read_books, sem materializar o catalogo inteiro
+    next_position = 1
+    seen = set()
+    for chunk in pd.read_csv(source, chunksize=chunksize):
+        length = len(chunk)
+        yield assign_ids(chunk, next_position, seen)
+        next_position += length
+
+
+class Catalog:
+    """Catalogo de livros em memoria, em colunas numpy indexadas pelo id do documento no Vespa."""
+
+    def __init__(self, source=DATA_URL, snapshot_path=SNAPSHOT_PATH):
+        self.source = source
+        self.snapshot_path = snapshot_path
+        self._lock = threading.Lock()
+        self._store = ({}, {})
+        self._snapshot_mtime = None
+        self.generation = 0
+        self.load()
+
+    def load(self):
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            self.reload()
+            return
+        df = read_books(self.source)
+        with self._lock:
+            if self.snapshot_path:
+                write_snapshot(df, self.snapshot_path)
+                self._snapshot_mtime = os.path.getmtime(self.snapshot_path)
+            self._swap(df)
+
+    def reload(self, path=None):
+        path = path or self.snapshot_path
+        with self._lock:
+            mtime = os.path.getmtime(path)
+            df = read_snapshot(path)
+            self._swap(df)
+            self._snapshot_mtime = mtime
+
+    def maybe_reload(self):
+        # Recarrega quando outro processo (ex.: admin.py) substitui o snapshot
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        if os.path.getmtime(self.snapshot_path) == self._snapshot_mtime:
+            return False
+        self.reload()
+        return True
+
+    def _swap(self, df):
+        # Colunas e posicoes trocadas juntas numa unica atribuicao, leitores nunca veem metade de um reload
+        columns = {name: df[name].to_numpy() for name in df.columns}
+        positions = {int(doc_id): pos for pos, doc_id in enumerate(columns['id'])}
+        self._store = (columns, positions)
+        self.generation += 1
+
+    @property
+    def version(self):
+        # Identifica a versao do indice de forma estavel entre workers e reinicios: mtime do snapshot
+        # gravado pelo admin.py (ou a geracao local, sem snapshot)
+        if self._snapshot_mtime is not None:
+            return f"{self._snapshot_mtime:.6f}"
+        return f"g{self.generation}"
+
+    def __len__(self):
+        return len(self._store[1])
+
+    def __contains__(self, doc_id):
+        return int(doc_id) in self._store[1]
+
+    def column(self, field):
+        return self._store[0][field]
+
+    def get(self, doc_id, field, default=""):
+        columns, positions = self._store
+        pos = positions.get(int(doc_id))
+        if pos is None:
+            return default
+        return columns[field][pos]
+
+    def enrich(self, hits, fields=("thumbnail",)):
+        # Completa os Hit (results.HitList) com campos do catalogo em memoria; campos ja preenchidos ficam
+        columns, positions = self._store
+        for hit in hits:
+            pos = positions.get(int(hit.id))
+            for field in fields:
+                if hit[field] is None:
+                    hit[field] = "" if pos is None else columns[field][pos]
+        return hits
@@ -0,0 +1,176 @@
+import fcntl
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from metrics import CACHE_REQUESTS
+
+E5_DIM = 384
+COLBERT_DIM = 128
+
+
+class QueryEmbeddings:
+    __slots__ = ("q", "qt")
+
+    def __init__(self, q, qt):
+        self.q = np.asarray(q, dtype=np.float32)
+        self.qt = np.asarray(qt, dtype=np.float32).reshape(-1, COLBERT_DIM)
+
+    def as_inputs(self, colbert=False):
+        # Tensores literais no formato curto aceito pelo Vespa: denso como lista, misto como {token: lista}
+        inputs = {"input.query(q)": np.round(self.q, 6).tolist()}
+        if colbert:
+            inputs["input.query(qt)"] = {str(i): row for i, row in enumerate(np.round(self.qt, 6).tolist())}
+        return inputs
+
+
+class EmbeddingCache:
+    """Cache dos embeddings de consulta (e5 e ColBERT) por texto normalizado.
+
+    Mantem as entradas mais recentes em memoria; as despejadas vao para arquivos binarios
+    lidos via np.memmap, compartilhados entre processos (escrita com flock). Com name, hits e misses
+    tambem vao para bookrec_cache_requests_total (/metrics).
+    """
+
+    def __init__(self, path=None, max_memory=2048, name=None):
+        self.path = path
+        self.name = name
+        self.max_memory = max_memory
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._index = {}
+        self._index_offset = 0
+        self._maps = {}
+        self._filling = set()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._refresh_index()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def get(self, key):
+        with self._lock:
+            embeddings = self._memory.get(key)
+            if embeddings is not None:
+                self._memory.move_to_end(key)
+                self._count("hit")
+                return embeddings
+            if self.path:
+                if key not in self._index:
+                    self._refresh_index()
+                location = self._index.get(key)
+                if location is not None:
+                    embeddings = self._read(*location)
+                    self._remember(key, embeddings, spill=False)
+                    self._count("hit")
+                    return embeddings
+            self._count("miss")
+            return None
+
+    def _count(self, result):
+        if result == "hit":
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.name is not None:
+            CACHE_REQUESTS.inc(cache=self.name, result=result)
+
+    def put(self, key, embeddings):
+        with self._lock:
+            self._remember(key, embeddings, spill=True)
+
+    def get_or_compute(self, key, compute):
+        embeddings = self.get(key)
+        if embeddings is None:
+            embeddings = compute()
+            if embeddings is not None:
+                self.put(key, embeddings)
+        return embeddings
+
+    def fill_async(self, key, compute, executor):
+        # Calcula em segundo plano uma entrada que faltou, sem segurar a consulta que a pediu;
+        # faltas simultaneas da mesma chave (ex.: os perfis de uma fusao) viram um unico calculo
+        with self._lock:
+            if key in self._filling:
+                return
+            self._filling.add(key)
+
+        def fill():
+            try:
+                embeddings = compute()
+                if embeddings is not None:
+                    self.put(key, embeddings)
+            finally:
+                with self._lock:
+                    self._filling.discard(key)
+
+        try:
+            executor.submit(fill)
+        except RuntimeError:
+            # Executor ja encerrado (close): fica para a proxima falta
+            with self._lock:
+                self._filling.discard(key)
+
+    def _remember(self, key, embeddings, spill):
+        self._memory[key] = embeddings
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory:
+            old_key, old_embeddings = self._memory.popitem(last=False)
+            if spill and self.path and old_key not in self._index:
+                self._spill(old_key, old_embeddings)
+
+    def flush(self):
+        # Grava em disco o que ainda esta so em memoria (ex.: ao encerrar o processo)
+        if not self.path:
+            return
+        with self._lock:
+            for key, embeddings in self._memory.items():
+                if key not in self._index:
+                    self._spill(key, embeddings)
+
+    def _spill(self, key, embeddings):
+        with open(self._file("lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            q_row = self._append("q.f32", embeddings.q) // (E5_DIM * 4)
+            qt_row = self._append("qt.f32", embeddings.qt) // (COLBERT_DIM * 4)
+            location = [q_row, qt_row, len(embeddings.qt)]
+            with open(self._file("index.jsonl"), "a") as f:
+                f.write(json.dumps([key, location]) + "\n")
+        self._index[key] = location
+
+    def _append(self, name, array):
+        with open(self._file(name), "ab") as f:
+            offset = f.tell()
+            f.write(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+        return offset
+
+    def _refresh_index(self):
+        # Le apenas as linhas novas, inclusive as escritas por outros processos
+        index_path = self._file("index.jsonl")
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, "rb") as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                key, location = json.loads(line)
+                self._index[key] = location
+                self._index_offset += len(line)
+
+    def _mapped(self, name, dim, rows_needed):
+        array = self._maps.get(name)
+        if array is None or len(array) < rows_needed:
+            # O arquivo cresceu desde o ultimo mapeamento
+            array = np.memmap(self._file(name), dtype=np.float32, mode="r").reshape(-1, dim)
+            self._maps[name] = array
+        return array
+
+    def _read(self, q_row, qt_row, n_tokens):
+        q = self._mapped("q.f32", E5_DIM, q_row + 1)[q_row]
+        qt = self._mapped("qt.f32", COLBERT_DIM, qt_row + n_tokens)[qt_row:qt_row + n_tokens]
+        return QueryEmbeddings(np.array(q), np.array(qt))
@@ -0,0 +1,254 @@
+import os
+import shutil
+import time
+import urllib.request
+import numpy as np
+from catalog import DATA_URL, iter_books
+from feed import content_hash
+from embedding_cache import E5_DIM, COLBERT_DIM
+
+E5_MODEL = "https://huggingface.co/intfloat/e5-small-v2/resolve/main/model.onnx"
+E5_TOKENIZER = "https://huggingface.co/intfloat/e5-small-v2/raw/main/tokenizer.json"
+COLBERT_MODEL = "https://huggingface.co/colbert-ir/colbertv2.0/resolve/main/model.onnx"
+COLBERT_TOKENIZER = "https://huggingface.co/colbert-ir/colbertv2.0/raw/main/tokenizer.json"
+COLBERT_PACKED_DIM = COLBERT_DIM // 8
+EMBEDDINGS_PATH = "embeddings"
+# Ponteiro para o diretorio da versao em uso dos arrays (ver save_version)
+CURRENT_FILE = "CURRENT"
+
+# Tokens especiais do colbert-embedder do Vespa (vocabulario BERT)
+CLS, SEP, MASK, QUERY_MARKER, DOCUMENT_MARKER = 101, 102, 103, 1, 2
+MAX_QUERY_TOKENS = 32
+MAX_DOCUMENT_TOKENS = 512
+
+
+def to_bfloat16(array):
+    # bfloat16 = 16 bits mais significativos do float32 (com arredondamento), guardado como uint16
+    bits = np.ascontiguousarray(array, dtype=np.float32).view(np.uint32)
+    return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+
+
+def from_bfloat16(array):
+    return (np.asarray(array, dtype=np.uint16).astype(np.uint32) << 16).view(np.float32)
+
+
+def current_version(path):
+    # Versao em uso gravada por save_version; None no formato antigo, com os .npy direto em path
+    try:
+        with open(os.path.join(path, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def version_dir(path, version):
+    return os.path.join(path, version) if version else path
+
+
+def save_version(path, arrays, keep=2):
+    # Grava os arrays num diretorio novo e troca o ponteiro CURRENT com um unico os.replace: quem carrega
+    # durante a reconstrucao le todos os arquivos da versao antiga ou todos da nova, nunca uma mistura.
+    # A versao anterior fica para quem leu o ponteiro antigo e ainda esta carregando
+    os.makedirs(path, exist_ok=True)
+    version = f"v{time.time_ns()}"
+    directory = os.path.join(path, version)
+    os.makedirs(directory)
+    for name, array in arrays:
+        np.save(os.path.join(directory, name), array)
+    tmp_path = os.path.join(path, f"{CURRENT_FILE}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(path, CURRENT_FILE))
+    versions = sorted(name for name in os.listdir(path) if name.startswith("v") and os.path.isdir(os.path.join(path, name)))
+    for old in versions[:-keep]:
+        shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    return version
+
+
+def pack_colbert(vectors):
+    # Mesmo formato do colbert-embedder com saida int8: 1 bit por dimensao (valor > 0), 128 -> 16 bytes
+    return np.packbits(np.asarray(vectors) > 0, axis=-1).view(np.int8)
+
+
+def unpack_colbert(packed):
+    # Equivalente ao unpack_bits(attribute(colbert)) dos perfis de ranking
+    return np.unpackbits(np.asarray(packed).view(np.uint8), axis=-1).astype(np.float32)
+
+
+class OnnxEmbedder:
+    """Roda fora do Vespa os mesmos modelos ONNX dos componentes e5 e colbert do pacote."""
+
+    def __init__(self, model_dir="models"):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError("OnnxEmbedder requer os pacotes onnxruntime e tokenizers") from e
+        os.makedirs(model_dir, exist_ok=True)
+        self.e5 = onnxruntime.InferenceSession(self._download(E5_MODEL, model_dir, "e5.onnx"))
+        self.e5_tokenizer = Tokenizer.from_file(self._download(E5_TOKENIZER, model_dir, "e5_tokenizer.json"))
+        self.e5_tokenizer.enable_truncation(512)
+        self.colbert = onnxruntime.InferenceSession(self._download(COLBERT_MODEL, model_dir, "colbert.onnx"))
+        self.colbert_tokenizer = Tokenizer.from_file(self._download(COLBERT_TOKENIZER, model_dir, "colbert_tokenizer.json"))
+        self.e5_inputs = {i.name for i in self.e5.get_inputs()}
+        self.colbert_inputs = {i.name for i in self.colbert.get_inputs()}
+
+    def _download(self, url, model_dir, name):
+        path = os.path.join(model_dir, name)
+        if not os.path.exists(path):
+            urllib.request.urlretrieve(url, path)
+        return path
+
+    def embed_e5(self, texts):
+        # hugging-face-embedder do Vespa: mean pooling sobre a attention mask, sem prefixo
+        encodings = self.e5_tokenizer.encode_batch(list(texts))
+        length = max(len(e.ids) for e in encodings)
+        ids = np.zeros((len(encodings), length), dtype=np.int64)
+        mask = np.zeros_like(ids)
+        for i, e in enumerate(encodings):
+            ids[i, :len(e.ids)] = e.ids
+            mask[i, :len(e.ids)] = 1
+        feeds = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self.e5_inputs:
+            feeds["token_type_ids"] = np.zeros_like(ids)
+        hidden = self.e5.run(None, feeds)[0]
+        summed = (hidden * mask[..., None]).sum(axis=1)
+        return (summed / mask.sum(axis=1, keepdims=True)).astype(np.float32)
+
+    def _run_colbert(self, ids, mask):
+        feeds = {"input_ids": ids[None, :], "attention_mask": mask[None, :]}
+        if "token_type_ids" in self.colbert_inputs:
+            feeds["token_type_ids"] = np.zeros_like(feeds["input_ids"])
+        return self.colbert.run(None, feeds)[0][0]
+
+    def embed_colbert_document(self, text):
+        encoding = self.colbert_tokenizer.encode(text, add_special_tokens=False)
+        tokens = encoding.ids[:MAX_DOCUMENT_TOKENS - 3]
+        ids = np.array([CLS, DOCUMENT_MARKER] + tokens + [SEP], dtype=np.int64)
+        vectors = self._run_colbert(ids, np.ones_like(ids))
+        # Tokens de pontuacao nao entram no tensor do documento
+        keep = [0, 1] + [i + 2 for i, token in enumerate(encoding.tokens[:len(tokens)]) if token.isalnum() or len(token) > 1] + [len(ids) - 1]
+        return pack_colbert(vectors[keep])
+
+    def embed_colbert_query(self, text):
+        tokens = self.colbert_tokenizer.encode(text, add_special_tokens=False).ids[:MAX_QUERY_TOKENS - 3]
+        ids = [CLS, QUERY_MARKER] + tokens + [SEP]
+        # Query augmentation do ColBERT: completa com [MASK] ate MAX_QUERY_TOKENS
+        ids = np.array(ids + [MASK] * (MAX_QUERY_TOKENS - len(ids)), dtype=np.int64)
+        return self._run_colbert(ids, np.ones_like(ids)).astype(np.float32)
+
+
+class DocumentEmbeddingStore:
+    """Embeddings dos documentos em arquivos .npy mapeados em memoria, por id e hash do conteudo.
+
+    e5.npy: (n, 384) float32 ou bfloat16 (uint16); colbert.npy: tokens de todos os documentos
+    concatenados, (total, 16) int8, com colbert_offsets.npy (n + 1) delimitando cada documento.
+    """
+
+    def __init__(self, path=EMBEDDINGS_PATH):
+        self.path = path
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.hashes = np.zeros(0, dtype="S40")
+        self.e5 = np.zeros((0, E5_DIM), dtype=np.float32)
+        self.colbert = np.zeros((0, COLBERT_PACKED_DIM), dtype=np.int8)
+        self.colbert_offsets = np.zeros(1, dtype=np.int64)
+        self._positions = {}
+        self.version = None
+        self.load()
+
+    def load(self):
+        # Todos os arquivos vem do diretorio apontado por CURRENT no momento da leitura
+        version = current_version(self.path)
+        directory = version_dir(self.path, version)
+        if not os.path.exists(os.path.join(directory, "ids.npy")):
+            return False
+        self.ids = np.load(os.path.join(directory, "ids.npy"))
+        self.hashes = np.load(os.path.join(directory, "hashes.npy"))
+        self.e5 = np.load(os.path.join(directory, "e5.npy"), mmap_mode="r")
+        self.colbert = np.load(os.path.join(directory, "colbert.npy"), mmap_mode="r")
+        self.colbert_offsets = np.load(os.path.join(directory, "colbert_offsets.npy"))
+        self._positions = {int(doc_id): pos for pos, doc_id in enumerate(self.ids)}
+        self.version = version
+        return True
+
+    def stale(self):
+        # Outro processo gravou uma versao nova (ex.: admin.py); quem serve troca por uma instancia nova
+        return current_version(self.path) != self.version
+
+    def __len__(self):
+        return len(self.ids)
+
+    def position(self, doc_id, doc_hash=None):
+        pos = self._positions.get(int(doc_id))
+        if pos is None or (doc_hash is not None and self.hashes[pos].decode() != doc_hash):
+            return None
+        return pos
+
+    def e5_vector(self, pos):
+        vector = self.e5[pos]
+        return from_bfloat16(vector) if vector.dtype == np.uint16 else np.asarray(vector, dtype=np.float32)
+
+    def e5_matrix(self):
+        return from_bfloat16(self.e5) if self.e5.dtype == np.uint16 else np.asarray(self.e5, dtype=np.float32)
+
+    def colbert_tokens(self, pos):
+        return self.colbert[self.colbert_offsets[pos]:self.colbert_offsets[pos + 1]]
+
+    def feed_fields(self, doc_id, doc_hash):
+        # Campos embedding/colbert no formato JSON de feed do Vespa, para o schema com tensores pre-calculados
+        pos = self.position(doc_id, doc_hash)
+        if pos is None:
+            raise KeyError(f"Documento {doc_id} sem embedding pre-calculado atualizado; rode 'python admin.py embed'")
+        return {
+            "embedding": self.e5_vector(pos).tolist(),
+            "colbert": {
+                "blocks": [
+                    {"address": {"description": "0", "token": str(token)}, "values": values}
+                    for token, values in enumerate(self.colbert_tokens(pos).tolist())
+                ]
+            },
+        }
+
+    def build(self, embedder, source=DATA_URL, dtype="bfloat16", chunksize=256):
+        # Reaproveita os vetores de documentos cujo hash nao mudou; so os novos/alterados passam pelos modelos
+        ids, hashes, e5_rows, colbert_rows = [], [], [], []
+        reused = computed = 0
+        for chunk in iter_books(source, chunksize=chunksize):
+            chunk_hashes = chunk.apply(content_hash, axis=1).tolist()
+            missing = []
+            for (_, row), doc_hash in zip(chunk.iterrows(), chunk_hashes):
+                pos = self.position(row['id'], doc_hash)
+                ids.append(int(row['id']))
+                hashes.append(doc_hash)
+                if pos is None:
+                    missing.append((len(e5_rows), row))
+                    e5_rows.append(None)
+                    colbert_rows.append(None)
+                else:
+                    e5_rows.append(self.e5_vector(pos))
+                    colbert_rows.append(np.array(self.colbert_tokens(pos)))
+                    reused += 1
+            if missing:
+                # Mesma entrada do campo embedding do schema: description . " " . categories
+                vectors = embedder.embed_e5([f"{row['description']} {row['categories']}" for _, row in missing])
+                for (slot, row), vector in zip(missing, vectors):
+                    e5_rows[slot] = vector
+                    colbert_rows[slot] = embedder.embed_colbert_document(str(row['description']))
+                computed += len(missing)
+
+        e5 = np.stack(e5_rows) if e5_rows else np.zeros((0, E5_DIM), dtype=np.float32)
+        if dtype == "bfloat16":
+            e5 = to_bfloat16(e5)
+        lengths = [len(tokens) for tokens in colbert_rows]
+        offsets = np.zeros(len(colbert_rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        colbert = np.concatenate(colbert_rows) if colbert_rows else np.zeros((0, COLBERT_PACKED_DIM), dtype=np.int8)
+        save_version(self.path, [
+            ("e5.npy", e5),
+            ("colbert.npy", colbert.astype(np.int8)),
+            ("colbert_offsets.npy", offsets),
+            ("hashes.npy", np.array(hashes, dtype="S40")),
+            ("ids.npy", np.array(ids, dtype=np.int64)),
+        ])
+        self.load()
+        return {"reused": reused, "computed": computed}
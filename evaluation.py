@@ -0,0 +1,286 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from book_rec_app import RANK_TYPES
+from benchmark import summarize
+from catalog import DATA_URL, read_books
+from feed import content_hash
+
+QUESTIONS_PATH = "eval_questions"
+CHECKPOINT_PATH = "eval_checkpoint.jsonl"
+
+
+class LLMQuestionGenerator:
+    """Perguntas geradas pelo LLM_Model dos notebooks (OpenAI)."""
+
+    def __init__(self, api_key=None):
+        from testes_modelos.llm_model import LLM_Model
+        self.model = LLM_Model(api_key or os.environ.get("OPENAI_API_KEY"))
+
+    def generate_generic_questions(self, book_description, book_category):
+        return self.model.generate_generic_questions(book_description, book_category)
+
+
+class TemplateQuestionGenerator:
+    """Substituto local e deterministico do LLM: perguntas montadas a partir da categoria e da descricao."""
+
+    WORD = re.compile(r"[A-Za-z]{5,}")
+
+    def generate_generic_questions(self, book_description, book_category):
+        words = []
+        for word in self.WORD.findall(str(book_description).lower()):
+            if word not in words:
+                words.append(word)
+        first_sentence = " ".join(str(book_description).split(".")[0].split()[:20])
+        category = str(book_category).lower() or "fiction"
+        return [q for q in [
+            f"books about {category}",
+            f"{category} books about {' '.join(words[:3])}" if words else "",
+            first_sentence,
+        ] if q.strip()]
+
+
+class QuestionCache:
+    """Perguntas de cada livro gravadas em disco (um arquivo por id), regeneradas se o conteudo mudar."""
+
+    def __init__(self, path=QUESTIONS_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, book_id):
+        return os.path.join(self.path, f"{book_id}.json")
+
+    def get(self, book_id, doc_hash):
+        try:
+            with open(self._file(book_id)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry["questions"] if entry.get("hash") == doc_hash else None
+
+    def put(self, book_id, doc_hash, questions):
+        tmp_path = f"{self._file(book_id)}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"hash": doc_hash, "questions": questions}, f)
+        os.replace(tmp_path, self._file(book_id))
+
+    def get_or_generate(self, row, generator):
+        book_id, doc_hash = int(row['id']), content_hash(row)
+        questions = self.get(book_id, doc_hash)
+        if questions is None:
+            questions = generator.generate_generic_questions(row['description'], row['categories'])
+            self.put(book_id, doc_hash, questions)
+        return questions
+
+
+class Checkpoint:
+    """Uma linha JSON por consulta avaliada; ao retomar, as ja registradas sem erro nao sao refeitas.
+
+    Consultas que falharam (erro do backend) e livros cuja geracao de perguntas falhou (erro do LLM, linha com
+    rank_type e question nulos) ficam registrados, mas sao repetidos na retomada; a linha mais recente de cada
+    consulta vale.
+    """
+
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Linha cortada por uma interrupcao no meio da escrita
+                        continue
+                    self.records[self.key(record)] = record
+        self._file = open(path, "a")
+
+    @staticmethod
+    def key(record):
+        return (record["rank_type"], record["book_id"], record["question"], record["k"])
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def done(self, key):
+        record = self.records.get(key)
+        return record is not None and record["error"] is None
+
+    def add(self, record):
+        with self._lock:
+            self.records[self.key(record)] = record
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def rank_metrics(ranks, book_index, k=10):
+    # ranks: posicao (1..k) do livro-alvo no resultado de cada pergunta, 0 se ficou de fora
+    # NDCG@k com um unico documento relevante = 1 / log2(posicao + 1); recall@k = fracao das perguntas
+    # que recuperam o livro (media por livro); hit rate = fracao dos livros recuperados por ao menos uma pergunta
+    ranks = np.asarray(ranks, dtype=np.int64)
+    book_index = np.asarray(book_index, dtype=np.int64)
+    if len(ranks) == 0:
+        return {"questions": 0, "books": 0, f"ndcg@{k}": 0.0, f"recall@{k}": 0.0, f"hit_rate@{k}": 0.0, "mrr": 0.0}
+    hit = (ranks > 0) & (ranks <= k)
+    gains = np.where(hit, 1.0 / np.log2(np.maximum(ranks, 1) + 1), 0.0)
+    reciprocal = np.where(hit, 1.0 / np.maximum(ranks, 1), 0.0)
+    _, book_index = np.unique(book_index, return_inverse=True)
+    questions_per_book = np.bincount(book_index)
+    hits_per_book = np.bincount(book_index, weights=hit)
+    return {
+        "questions": int(len(ranks)),
+        "books": int(len(questions_per_book)),
+        f"ndcg@{k}": round(float(gains.mean()), 4),
+        f"recall@{k}": round(float((hits_per_book / questions_per_book).mean()), 4),
+        f"hit_rate@{k}": round(float((hits_per_book > 0).mean()), 4),
+        "mrr": round(float(reciprocal.mean()), 4),
+    }
+
+
+class Evaluator:
+    """Avalia os tipos de ranking com perguntas geradas por livro: qualidade e latencia por perfil.
+
+    As perguntas sao geradas em paralelo (e guardadas no QuestionCache) e todas as consultas de todos os
+    perfis vao para o mesmo pool de threads; cada resultado e gravado no Checkpoint assim que chega.
+    """
+
+    def __init__(self, engine, generator, questions=None, checkpoint=None, k=10, workers=16):
+        self.engine = engine
+        self.generator = generator
+        self.questions = questions or QuestionCache()
+        self.checkpoint = checkpoint or Checkpoint()
+        self.k = k
+        self.workers = workers
+
+    def generate(self, books):
+        # Livros cuja geracao falhou ficam de fora desta execucao
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            generated = executor.map(self._questions, [row for _, row in books.iterrows()])
+            return {int(book_id): questions for book_id, questions in zip(books['id'], generated) if questions is not None}
+
+    def _questions(self, row):
+        # Uma falha do LLM num livro nao derruba a avaliacao: vai para o Checkpoint e, como nada foi guardado
+        # no QuestionCache, a retomada gera as perguntas do livro de novo
+        start = time.perf_counter()
+        try:
+            return self.questions.get_or_generate(row, self.generator)
+        except Exception as e:
+            self.checkpoint.add({
+                "rank_type": None, "book_id": int(row['id']), "question": None, "k": self.k,
+                "rank": 0, "latency_s": time.perf_counter() - start, "error": repr(e),
+            })
+            return None
+
+    def _evaluate(self, rank_type, book_id, question):
+        start = time.perf_counter()
+        try:
+            results = self.engine.search(question, rank_type, limit=self.k, fields=("id",))
+            ids = [int(doc_id) for doc_id in results['id']]
+            rank = ids.index(book_id) + 1 if book_id in ids else 0
+            error = None
+        except Exception as e:
+            rank, error = 0, repr(e)
+        self.checkpoint.add({
+            "rank_type": rank_type, "book_id": book_id, "question": question, "k": self.k,
+            "rank": rank, "latency_s": time.perf_counter() - start, "error": error,
+        })
+
+    def run(self, books, rank_types=tuple(RANK_TYPES)):
+        questions = self.generate(books)
+        skipped_books = len(books) - len(questions)
+        tasks = [
+            (rank_type, book_id, question)
+            for rank_type in rank_types
+            for book_id, book_questions in questions.items()
+            for question in book_questions
+            if not self.checkpoint.done((rank_type, book_id, question, self.k))
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(lambda task: self._evaluate(*task), tasks))
+        return self.report(questions, rank_types, skipped_books)
+
+    def report(self, questions, rank_types, skipped_books=0):
+        report = {}
+        for rank_type in rank_types:
+            records = [
+                self.checkpoint.records[key] for key in (
+                    (rank_type, book_id, question, self.k)
+                    for book_id, book_questions in questions.items() for question in book_questions
+                ) if key in self.checkpoint
+            ]
+            ok = [record for record in records if record["error"] is None]
+            report[rank_type] = {
+                **rank_metrics([r["rank"] for r in ok], [r["book_id"] for r in ok], self.k),
+                "errors": len(records) - len(ok),
+                # Livros sem perguntas por falha na geracao (iguais em todos os perfis)
+                "skipped_books": skipped_books,
+                "latency_ms": summarize([r["latency_s"] for r in ok]) if ok else None,
+            }
+        return report
+
+
+def make_generator(args):
+    if args.generator == "template":
+        return TemplateQuestionGenerator()
+    return LLMQuestionGenerator()
+
+
+def make_engine(args):
+    from book_rec_app import create_engine
+    # Sem cache de resultados: a latencia medida e a do backend
+    if args.backend == "local":
+        return create_engine("local", source=args.source, embeddings_path=args.embeddings, cache_size=0)
+    return create_engine("vespa", url=args.vespa_url, port=args.vespa_port, pool_size=max(args.workers, 8), cache_size=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Avaliacao offline (NDCG/recall/hit rate e latencia) dos tipos de ranking")
+    parser.add_argument("--backend", choices=["vespa", "local"], default="vespa")
+    parser.add_argument("--generator", choices=["llm", "template"], default="llm", help="llm usa OPENAI_API_KEY; template roda localmente")
+    parser.add_argument("--source", default=DATA_URL)
+    parser.add_argument("--sample", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--rank-types", nargs="+", default=list(RANK_TYPES), choices=list(RANK_TYPES))
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--questions", default=QUESTIONS_PATH)
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--vespa-url", default="http://localhost")
+    parser.add_argument("--vespa-port", type=int, default=8080)
+    parser.add_argument("--embeddings", default="embeddings", help="Embeddings pre-calculados (backend local)")
+    parser.add_argument("--output", default="eval_output.json")
+    args = parser.parse_args()
+
+    books = read_books(args.source)
+    books = books.sample(n=min(args.sample, len(books)), random_state=args.seed)
+    checkpoint = Checkpoint(args.checkpoint)
+    engine = make_engine(args)
+    try:
+        evaluator = Evaluator(engine, make_generator(args), QuestionCache(args.questions), checkpoint, k=args.k, workers=args.workers)
+        report = evaluator.run(books, args.rank_types)
+    finally:
+        checkpoint.close()
+        engine.close()
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    for rank_type, result in report.items():
+        latency = result["latency_ms"] or {}
+        print(
+            f"{rank_type:24} ndcg@{args.k}={result[f'ndcg@{args.k}']:.4f} recall@{args.k}={result[f'recall@{args.k}']:.4f} "
+            f"hit_rate@{args.k}={result[f'hit_rate@{args.k}']:.4f} mrr={result['mrr']:.4f} "
+            f"p50={latency.get('p50')} p95={latency.get('p95')} errors={result['errors']} skipped_books={result['skipped_books']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import numpy as np
+
+MANIFEST_PATH = "feed_manifest.json"
+# Texto que define os embeddings e as perguntas de avaliacao de um livro
+HASHED_FIELDS = ["title", "authors", "description", "categories"]
+# Campos enviados no feed (transform_row): o texto e a nota usada nos filtros min_rating/max_rating
+FED_FIELDS = HASHED_FIELDS + ["average_rating"]
+# Versao do formato do documento enviado (transform_row); mudar a versao faz o feed incremental reenviar tudo
+FEED_VERSION = 3
+
+
+def content_hash(row, fields=HASHED_FIELDS):
+    text = "\x1f".join(str(row.get(field, "")) for field in fields)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def document_hash(row):
+    # Hash do manifesto: muda com qualquer campo enviado, inclusive so a nota
+    return content_hash(row, FED_FIELDS)
+
+
+class FeedManifest:
+    """Hash (document_hash) de cada documento ja alimentado no Vespa, por id, prefixado pela FEED_VERSION e variante.
+
+    variant identifica o schema alimentado e a origem dos embeddings (ver feed_variant em book_rec_app.py):
+    documentos alimentados em outra variante contam como alterados no feed incremental.
+    """
+
+    def __init__(self, path=MANIFEST_PATH, variant="embed"):
+        self.path = path
+        self.variant = variant
+        self._lock = threading.Lock()
+        self.hashes = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.hashes = json.load(f)
+
+    def diff(self, df, force=False):
+        # Retorna as linhas novas/alteradas, quantos documentos ficaram iguais e o hash de cada
+        # documento pendente; force=True considera todas as linhas alteradas
+        if len(df) == 0:
+            return df, 0, {}
+        hashes = df.apply(document_hash, axis=1).to_numpy()
+        ids = df['id'].astype(str).to_numpy()
+        changed = np.array([force or self.hashes.get(doc_id) != self._versioned(doc_hash) for doc_id, doc_hash in zip(ids, hashes)], dtype=bool)
+        pending = dict(zip(ids[changed], hashes[changed]))
+        return df[changed].copy(), len(df) - len(pending), pending
+
+    def _versioned(self, doc_hash):
+        return f"{FEED_VERSION}:{self.variant}:{doc_hash}"
+
+    def stale(self, seen_ids):
+        # Ids presentes no manifesto que nao apareceram mais na fonte
+        with self._lock:
+            return sorted(set(self.hashes) - set(seen_ids), key=int)
+
+    def mark_fed(self, doc_id, doc_hash):
+        with self._lock:
+            self.hashes[str(doc_id)] = self._versioned(doc_hash)
+
+    def mark_removed(self, doc_id):
+        with self._lock:
+            self.hashes.pop(str(doc_id), None)
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with self._lock:
+            with open(tmp_path, "w") as f:
+                json.dump(self.hashes, f)
+        os.replace(tmp_path, self.path)
+
+
+class FeedStats:
+    """Metricas de um feed: vazao, latencia por documento (amostrada) e falhas."""
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._samples = []
+        self._seen = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.errors = []
+        self.start_time = time.perf_counter()
+        self.end_time = None
+
+    def submitted(self, doc_id):
+        self._in_flight[str(doc_id)] = time.perf_counter()
+
+    def completed(self, doc_id, successful, error=None):
+        end = time.perf_counter()
+        start = self._in_flight.pop(str(doc_id), end)
+        with self._lock:
+            if successful:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+                if len(self.errors) < 100:
+                    self.errors.append({"id": str(doc_id), "error": error})
+            # Amostragem por reservatorio: memoria constante mesmo em catalogos muito grandes
+            self._seen += 1
+            if len(self._samples) < self.max_samples:
+                self._samples.append(end - start)
+            else:
+                slot = random.randrange(self._seen)
+                if slot < self.max_samples:
+                    self._samples[slot] = end - start
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    def summary(self):
+        elapsed = (self.end_time or time.perf_counter()) - self.start_time
+        total = self.succeeded + self.failed
+        with self._lock:
+            samples = np.array(self._samples) * 1000
+        percentiles = np.percentile(samples, [50, 95, 99]) if len(samples) else [0.0, 0.0, 0.0]
+        return {
+            "documents": total,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "error_rate": self.failed / total if total else 0.0,
+            "elapsed_s": round(elapsed, 3),
+            "docs_per_s": round(total / elapsed, 2) if elapsed > 0 else 0.0,
+            "latency_ms": {"p50": round(float(percentiles[0]), 2), "p95": round(float(percentiles[1]), 2), "p99": round(float(percentiles[2]), 2)},
+            "errors": list(self.errors),
+        }
@@ -0,0 +1,52 @@
+import gzip
+import hashlib
+import json
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    # brotli e opcional; sem ele as respostas saem em gzip
+    brotli = None
+
+# Abaixo disso a compressao nao compensa o custo
+MIN_COMPRESS_SIZE = 512
+
+
+def make_etag(*parts):
+    # ETag fraca: o conteudo e o mesmo, mas os bytes mudam conforme o Content-Encoding
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")).hexdigest()
+    return digest[:32]
+
+
+def not_modified(etag):
+    return request.if_none_match.contains_weak(etag)
+
+
+def json_response(payload, etag=None, max_age=60, status=200):
+    # JSON compacto, comprimido conforme o Accept-Encoding, com ETag e Cache-Control para navegador/CDN
+    body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    response = Response(status=status, mimetype="application/json")
+    if len(body) >= MIN_COMPRESS_SIZE:
+        accepted = request.accept_encodings
+        if brotli is not None and accepted["br"]:
+            body = brotli.compress(body, quality=5)
+            response.headers["Content-Encoding"] = "br"
+        elif accepted["gzip"]:
+            body = gzip.compress(body, compresslevel=5)
+            response.headers["Content-Encoding"] = "gzip"
+    response.set_data(body)
+    return cache_headers(response, etag, max_age)
+
+
+def cache_headers(response, etag=None, max_age=60):
+    response.headers["Vary"] = "Accept-Encoding"
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def not_modified_response(etag, max_age=60):
+    return cache_headers(Response(status=304), etag, max_age)
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+class LatencyTracker:
+    """Janela movel das ultimas latencias (s) de cada perfil/configuracao de consulta.
+
+    Falhas e timeouts entram como latencia infinita (record_failure), e amostras com mais de max_age
+    segundos sao ignoradas: uma configuracao descartada por lentidao ou falhas volta a ser tentada.
+    """
+
+    def __init__(self, window=200, min_samples=3, max_age=60.0):
+        self.window = window
+        self.min_samples = min_samples
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, key, seconds):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append((time.monotonic(), seconds))
+
+    def record_failure(self, key):
+        self.record(key, float("inf"))
+
+    def percentile(self, key, q=95):
+        # None enquanto nao ha amostras recentes suficientes para estimar
+        cutoff = time.monotonic() - self.max_age
+        with self._lock:
+            samples = [seconds for timestamp, seconds in self._samples.get(key, ()) if timestamp >= cutoff]
+        if len(samples) < self.min_samples:
+            return None
+        # "higher" devolve sempre uma amostra real, sem interpolar com as falhas (inf)
+        return float(np.percentile(samples, q, method="higher"))
+
+
+class CircuitBreaker:
+    """Abre apos falhas (ou respostas lentas) consecutivas; apos reset_timeout deixa passar uma tentativa."""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
@@ -0,0 +1,262 @@
+import re
+import time
+from collections import Counter
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from book_rec_app import VespaApp, QUERY_FIELDS, SHORT_FIELDS, DEFAULT_TARGET_HITS, split_list
+from catalog import DATA_URL, read_books
+from embeddings import EMBEDDINGS_PATH, DocumentEmbeddingStore, unpack_colbert
+from embedding_cache import QueryEmbeddings
+from feed import content_hash
+from query_cache import normalize_query
+from results import Hit, HitList
+from metrics import span
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+# Parametros padrao do bm25 do Vespa
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_RERANK_COUNT = 100
+
+# Espelho dos perfis de create_package: (primeira fase, segunda fase, rerank-count)
+# "rrf" e a fase global do perfil fusion: reciprocal_rank_fusion(bm25sum, closeness)
+PROFILES = {
+    "bm25": ("bm25sum", None, None),
+    "semantic": ("closeness", None, None),
+    "fusion": ("closeness", "rrf", 1000),
+    "bm25_semantic": ("bm25sum", "closeness", 1000),
+    "colbert_local": ("closeness", "max_sim_local", DEFAULT_RERANK_COUNT),
+    "colbert_global": ("closeness", "max_sim_global", 1000),
+    "bm25_colbert": ("bm25sum+closeness", "max_sim_local", 500),
+    "bm25_colbert_global": ("bm25sum+closeness", "max_sim_global", 500),
+}
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class BM25Field:
+    """Indice BM25 de um campo: matriz esparsa documento x termo ja com os pesos bm25 de cada par."""
+
+    def __init__(self, texts, vocabulary):
+        rows, cols, counts = [], [], []
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[row] = len(tokens)
+            for token, count in Counter(tokens).items():
+                rows.append(row)
+                cols.append(vocabulary.setdefault(token, len(vocabulary)))
+                counts.append(count)
+        self.rows = np.array(rows, dtype=np.int64)
+        self.cols = np.array(cols, dtype=np.int64)
+        self.tf = np.array(counts, dtype=np.float32)
+        self.lengths = lengths
+
+    def weights(self, n_terms):
+        n_docs = len(self.lengths)
+        avg_length = max(float(self.lengths.mean()), 1.0) if n_docs else 1.0
+        doc_freq = np.bincount(self.cols, minlength=n_terms)
+        idf = np.log(1 + (n_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[self.rows] / avg_length)
+        values = idf[self.cols] * self.tf * (BM25_K1 + 1) / (self.tf + norm)
+        # CSC: somar as colunas dos termos da consulta e barato
+        return sparse.csc_matrix((values, (self.rows, self.cols)), shape=(n_docs, n_terms), dtype=np.float32)
+
+
+class LocalEngine(VespaApp):
+    """Motor de busca em processo com a mesma interface de consulta do VespaApp, sem Docker.
+
+    BM25 em matriz esparsa sobre description e categories (bm25sum), busca exata por forca bruta em
+    numpy para o closeness do e5 e MaxSim vetorizado sobre os tokens ColBERT empacotados (16 bytes).
+    Os embeddings dos documentos vem do DocumentEmbeddingStore (admin.py embed) e os da consulta do
+    OnnxEmbedder, com o mesmo EmbeddingCache usado pelo VespaApp.
+    """
+
+    def __init__(self, source=DATA_URL, embeddings_path=EMBEDDINGS_PATH, embedder=None,
+                 cache_size=1024, cache_ttl=300.0, embedding_cache_path=None, workers=8):
+        self._init_query_state(cache_size, cache_ttl, embedding_cache_path, workers)
+        self.embedder = embedder
+        self.build(read_books(source), DocumentEmbeddingStore(embeddings_path))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.fusion_executor.shutdown(wait=False, cancel_futures=True)
+        self.embeddings.flush()
+
+    def build(self, df, store):
+        self.books = df.reset_index(drop=True)
+        self.ids = self.books['id'].astype(str).to_numpy()
+        vocabulary = {}
+        description = BM25Field(self.books['description'], vocabulary)
+        categories = BM25Field(self.books['categories'], vocabulary)
+        default_fields = [BM25Field(self.books[field], vocabulary) for field in ("title", "authors")]
+        self.vocabulary = vocabulary
+        self.bm25 = description.weights(len(vocabulary)) + categories.weights(len(vocabulary))
+        # Fieldset default (title, authors, description, categories): define quem casa com userQuery()
+        matches = [field.weights(len(vocabulary)) for field in [description, categories] + default_fields]
+        self.matches = (sum(matches) > 0).astype(np.float32).tocsc()
+
+        # Equivalentes dos atributos category_list/author_list (sem diferenciar maiusculas) e average_rating
+        self.category_lists = [split_list(value) for value in self.books['categories']]
+        self.category_sets = [frozenset(v.casefold() for v in values) for values in self.category_lists]
+        self.author_sets = [frozenset(v.casefold() for v in split_list(value)) for value in self.books['authors']]
+        self.ratings = pd.to_numeric(self.books.get('average_rating', pd.Series(np.nan, index=self.books.index)), errors="coerce").to_numpy(dtype=np.float64)
+
+        n_docs = len(self.books)
+        self.e5 = np.zeros((n_docs, 384), dtype=np.float32)
+        self.has_embedding = np.zeros(n_docs, dtype=bool)
+        token_rows, lengths = [], np.zeros(n_docs, dtype=np.int64)
+        for pos, (_, row) in enumerate(self.books.iterrows()):
+            store_pos = store.position(row['id'], content_hash(row))
+            if store_pos is None:
+                token_rows.append(np.zeros((0, 16), dtype=np.int8))
+                continue
+            self.e5[pos] = store.e5_vector(store_pos)
+            self.has_embedding[pos] = True
+            tokens = store.colbert_tokens(store_pos)
+            token_rows.append(np.asarray(tokens))
+            lengths[pos] = len(tokens)
+        norms = np.linalg.norm(self.e5, axis=1, keepdims=True)
+        self.e5 /= np.where(norms > 0, norms, 1)
+        self.colbert = np.concatenate(token_rows) if token_rows else np.zeros((0, 16), dtype=np.int8)
+        self.colbert_offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    def _query_embeddings(self, query):
+        if self.embedder is None:
+            from embeddings import OnnxEmbedder
+            self.embedder = OnnxEmbedder()
+
+        def compute():
+            return QueryEmbeddings(self.embedder.embed_e5([query])[0], self.embedder.embed_colbert_query(query))
+
+        return self.embeddings.get_or_compute(normalize_query(query), compute)
+
+    def _bm25sum(self, query):
+        terms = [self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary]
+        if not terms:
+            return np.zeros(len(self.ids), dtype=np.float32), np.zeros(len(self.ids), dtype=bool)
+        scores = np.asarray(self.bm25[:, terms].sum(axis=1)).ravel()
+        matched = np.asarray(self.matches[:, terms].sum(axis=1)).ravel() > 0
+        return scores, matched
+
+    def _filter_mask(self, filters):
+        # Mesma semantica de filter_clause: valores de uma chave em OR, chaves diferentes em AND
+        mask = np.ones(len(self.ids), dtype=bool)
+        if not filters:
+            return mask
+        for key, sets in (("category", self.category_sets), ("author", self.author_sets)):
+            values = filters.get(key)
+            if values:
+                wanted = {v.casefold() for v in ([values] if isinstance(values, str) else values)}
+                mask &= np.fromiter((not wanted.isdisjoint(s) for s in sets), dtype=bool, count=len(sets))
+        if filters.get("min_rating") is not None:
+            mask &= self.ratings >= float(filters["min_rating"])
+        if filters.get("max_rating") is not None:
+            mask &= self.ratings <= float(filters["max_rating"])
+        return mask
+
+    def _facets(self, candidates):
+        counts = Counter(category for pos in candidates for category in self.category_lists[pos])
+        return dict(counts.most_common(20))
+
+    def _closeness(self, q, target_hits, mask=None):
+        # angular: closeness = 1 / (1 + angulo); fora dos targetHits vizinhos o closeness e 0
+        # mask: filtros aplicados antes da busca, como o pre-filtro do HNSW no Vespa
+        eligible = self.has_embedding if mask is None else self.has_embedding & mask
+        q = q / max(np.linalg.norm(q), 1e-12)
+        cosine = np.where(eligible, self.e5 @ q, -1.0)
+        k = min(target_hits, int(eligible.sum()))
+        neighbors = np.argpartition(-cosine, k - 1)[:k] if k else np.zeros(0, dtype=np.int64)
+        closeness = np.zeros(len(self.ids), dtype=np.float32)
+        closeness[neighbors] = 1.0 / (1.0 + np.arccos(np.clip(cosine[neighbors], -1.0, 1.0)))
+        retrieved = np.zeros(len(self.ids), dtype=bool)
+        retrieved[neighbors] = True
+        return closeness, retrieved
+
+    def _max_sim(self, qt, candidates):
+        # sum_querytoken max_token (query(qt) . unpack_bits(colbert)); description tem um unico elemento,
+        # entao as variantes local e global coincidem
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        starts, ends = self.colbert_offsets[candidates], self.colbert_offsets[candidates + 1]
+        has_tokens = ends > starts
+        if not has_tokens.any():
+            return scores
+        rows = np.concatenate([np.arange(a, b) for a, b in zip(starts[has_tokens], ends[has_tokens])])
+        similarity = qt @ unpack_colbert(self.colbert[rows]).T
+        segment_starts = np.concatenate([[0], np.cumsum((ends - starts)[has_tokens])[:-1]])
+        scores[has_tokens] = np.maximum.reduceat(similarity, segment_starts, axis=1).sum(axis=0)
+        return scores
+
+    def query_similar(self, vector, exclude_id=None, limit=10, target_hits=100, fields=SHORT_FIELDS):
+        closeness, retrieved = self._closeness(np.asarray(vector, dtype=np.float32), target_hits)
+        if exclude_id is not None:
+            retrieved &= self.ids != str(exclude_id)
+        candidates = np.flatnonzero(retrieved)
+        positions = candidates[np.argsort(-closeness[candidates], kind="stable")][:limit]
+        return self._hits(positions, closeness[positions], fields)
+
+    def document_embedding(self, doc_id):
+        pos = np.flatnonzero(self.ids == str(doc_id))
+        if len(pos) == 0 or not self.has_embedding[pos[0]]:
+            return None
+        return self.e5[pos[0]]
+
+    def _hits(self, positions, relevance, fields):
+        hits = HitList()
+        for pos, score in zip(positions.tolist(), relevance.tolist()):
+            record = {field: self.books.at[pos, field] for field in fields if field not in ('id', 'average_rating')}
+            if 'average_rating' in fields:
+                rating = self.ratings[pos]
+                record['average_rating'] = None if np.isnan(rating) else float(rating)
+            hits.append(Hit(id=self.ids[pos], relevance=score, **record))
+        return hits
+
+    def _execute(self, ranking, query, where, embed, limit, rerank_count, timeout, filters=None, facets=False, fields=QUERY_FIELDS, offset=0):
+        start = time.perf_counter()
+        first_phase, second_phase, profile_rerank = PROFILES[ranking]
+        target_hits = int(re.search(r"targetHits:(\d+)", where).group(1)) if "nearestNeighbor" in where else DEFAULT_TARGET_HITS
+
+        bm25sum, matched = self._bm25sum(query) if "userQuery()" in where else (np.zeros(len(self.ids), dtype=np.float32), np.zeros(len(self.ids), dtype=bool))
+        with span("embed"):
+            embeddings = self._query_embeddings(query) if embed else None
+        mask = self._filter_mask(filters)
+        closeness = np.zeros(len(self.ids), dtype=np.float32)
+        if "nearestNeighbor" in where:
+            closeness, retrieved = self._closeness(embeddings.q, target_hits, mask)
+            matched = matched | retrieved
+
+        candidates = np.flatnonzero(matched & mask)
+        if first_phase == "bm25sum":
+            scores = bm25sum[candidates]
+        elif first_phase == "closeness":
+            scores = closeness[candidates]
+        else:
+            scores = bm25sum[candidates] + closeness[candidates]
+        order = candidates[np.argsort(-scores, kind="stable")]
+        relevance = np.zeros(len(self.ids), dtype=np.float32)
+        relevance[candidates] = scores
+
+        if second_phase is not None and len(order):
+            rerank = min(rerank_count or profile_rerank, len(order))
+            top = order[:rerank]
+            if second_phase == "rrf":
+                bm25_rank = np.argsort(np.argsort(-bm25sum[top], kind="stable"), kind="stable") + 1
+                closeness_rank = np.argsort(np.argsort(-closeness[top], kind="stable"), kind="stable") + 1
+                rescored = 1.0 / (60 + bm25_rank) + 1.0 / (60 + closeness_rank)
+            elif second_phase == "closeness":
+                rescored = closeness[top]
+            else:
+                rescored = self._max_sim(embeddings.qt, top)
+            # Documentos reranqueados ficam acima dos demais, como no Vespa
+            relevance[top] = rescored
+            top = top[np.argsort(-rescored, kind="stable")]
+            order = np.concatenate([top, order[rerank:]])
+
+        page = order[offset:offset + limit]
+        hits = self._hits(page, relevance[page], fields)
+        if facets:
+            hits.attrs["facets"] = self._facets(candidates)
+        return hits, {"querytime": time.perf_counter() - start, "summaryfetchtime": 0.0, "searchtime": time.perf_counter() - start}
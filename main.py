@@ -1,11 +1,128 @@
-from flask import Flask, render_template, request, send_from_directory
-import pandas as pd
-from book_rec_app import VespaApp
+import atexit
+import json
+import logging
+import os
+from flask import Flask, Response, jsonify, render_template, request, send_from_directory
+from book_rec_app import FULL_FIELDS, MAX_OFFSET, PAGE_WINDOW, RANK_TYPES, SHORT_FIELDS, create_engine
+from catalog import Catalog, DATA_URL, SNAPSHOT_PATH
+from embeddings import EMBEDDINGS_PATH, DocumentEmbeddingStore
+from neighbors import NEIGHBORS_PATH, NeighborTable
+from results import Hit, HitList
+from http_cache import json_response, make_etag, not_modified, not_modified_response
+from query_cache import normalize_query
+from pagination import decode_cursor, encode_cursor
+from typeahead import TypeaheadIndex
+from metrics import REGISTRY, REQUEST_SECONDS, end_trace, record_query, span, start_trace
 
 app_flask = Flask(__name__)
-app_vespa = VespaApp()
+# BOOKREC_ENGINE=vespa: o deploy e o feed ficam no admin.py (python admin.py deploy) e cada worker apenas conecta
+# BOOKREC_ENGINE=local: motor em processo sobre o catalogo e os embeddings pre-calculados (python admin.py embed)
+ENGINE = os.environ.get("BOOKREC_ENGINE", "vespa")
+engine_options = {
+    "cache_size": int(os.environ.get("BOOKREC_CACHE_SIZE", "1024")),
+    "cache_ttl": float(os.environ.get("BOOKREC_CACHE_TTL", "300")),
+    "embedding_cache_path": os.environ.get("BOOKREC_EMBEDDING_CACHE", "embedding_cache"),
+}
+if ENGINE == "vespa":
+    engine_options.update(
+        url=os.environ.get("VESPA_URL", "http://localhost"),
+        port=int(os.environ.get("VESPA_PORT", "8080")),
+        pool_size=int(os.environ.get("VESPA_POOL_SIZE", "25")),
+        timeout=float(os.environ.get("VESPA_TIMEOUT", "10")),
+    )
+else:
+    engine_options.update(
+        source=os.environ.get("BOOKREC_CATALOG", DATA_URL),
+        embeddings_path=os.environ.get("BOOKREC_EMBEDDINGS", EMBEDDINGS_PATH),
+    )
+app_vespa = create_engine(ENGINE, **engine_options)
+atexit.register(app_vespa.close)
+app_vespa.add_listener(record_query)
+# Prazo total (s) da busca com fusao; perfis que nao responderem a tempo ficam de fora
+FUSION_DEADLINE = float(os.environ.get("BOOKREC_FUSION_DEADLINE", "1.0"))
+# Orcamento de latencia padrao (ms); vazio desliga a degradacao automatica, a menos que a requisicao envie budget_ms
+LATENCY_BUDGET_MS = os.environ.get("BOOKREC_LATENCY_BUDGET_MS", "")
+catalog = Catalog(
+    source=os.environ.get("BOOKREC_CATALOG", DATA_URL),
+    snapshot_path=os.environ.get("BOOKREC_CATALOG_SNAPSHOT", SNAPSHOT_PATH),
+)
+# Autocomplete de titulos/autores servido da memoria, sem ir ao Vespa; reconstruido junto com o catalogo
+typeahead = TypeaheadIndex.from_catalog(catalog)
 
-empty_df = pd.DataFrame(columns=["id", "title", "authors", "description", "categories", "thumbnail"])
+# Tabela de vizinhos pre-calculada (admin.py neighbors); sem ela, a busca vai ao engine com o embedding armazenado
+# (do store local de admin.py embed ou, sem ele, lido do proprio engine). Recarregados como o catalogo
+neighbor_table = NeighborTable(os.environ.get("BOOKREC_NEIGHBORS", NEIGHBORS_PATH))
+embedding_store = DocumentEmbeddingStore(os.environ.get("BOOKREC_EMBEDDINGS", EMBEDDINGS_PATH))
+
+# Cache HTTP da API JSON (s); as ETags mudam quando o catalogo/indice muda
+API_MAX_AGE = int(os.environ.get("BOOKREC_API_MAX_AGE", "60"))
+
+# Log de consultas lentas (ms): consulta, perfil e tempo de cada etapa; vazio desliga
+SLOW_QUERY_MS = os.environ.get("BOOKREC_SLOW_QUERY_MS", "")
+slow_query_log = logging.getLogger("bookrec.slow_query")
+if os.environ.get("BOOKREC_SLOW_QUERY_LOG"):
+    slow_query_log.addHandler(logging.FileHandler(os.environ["BOOKREC_SLOW_QUERY_LOG"]))
+# Varios workers (gunicorn -w N): cada um grava suas metricas em BOOKREC_METRICS_DIR e /metrics soma todos.
+# O diretorio deve ser esvaziado antes de subir os workers
+if os.environ.get("BOOKREC_METRICS_DIR"):
+    REGISTRY.enable_multiprocess(os.environ["BOOKREC_METRICS_DIR"])
+    atexit.register(REGISTRY.dump)
+# Rotas de busca cujo tempo entra no log de consultas lentas
+SEARCH_ENDPOINTS = ("search", "api_search", "similar")
+
+# Listas de resultado: o Vespa devolve o resumo "short" e a descricao/capa vem do catalogo em memoria
+CATALOG_FIELDS = ("description", "thumbnail")
+
+@app_flask.before_request
+def begin_request_trace():
+    start_trace()
+
+@app_flask.after_request
+def finish_request_trace(response):
+    trace = end_trace()
+    if trace is None or request.endpoint is None:
+        return response
+    elapsed = trace.elapsed()
+    REQUEST_SECONDS.observe(elapsed, endpoint=request.endpoint)
+    REGISTRY.maybe_dump()
+    if SLOW_QUERY_MS and request.endpoint in SEARCH_ENDPOINTS and elapsed * 1000 >= float(SLOW_QUERY_MS):
+        params = request.form if request.method == "POST" else request.args
+        slow_query_log.warning(json.dumps({
+            "endpoint": request.endpoint,
+            "query": params.get("query"),
+            "rank_type": params.get("rank_type"),
+            "status": response.status_code,
+            "total_ms": round(elapsed * 1000, 3),
+            "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in trace.stages.items()},
+            "queries": trace.queries,
+        }, default=str))
+    return response
+
+@app_flask.route("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+def refresh_catalog():
+    # Snapshot novo significa feed concluido pelo admin.py: os resultados em cache ficaram velhos
+    global typeahead, neighbor_table, embedding_store
+    if catalog.maybe_reload():
+        app_vespa.invalidate()
+        typeahead = TypeaheadIndex.from_catalog(catalog)
+    # Versao nova gravada pelo admin.py neighbors/embed: instancia nova, trocada numa unica atribuicao
+    if neighbor_table.stale():
+        neighbor_table = NeighborTable(neighbor_table.path)
+    if embedding_store.stale():
+        embedding_store = DocumentEmbeddingStore(embedding_store.path)
+
+def read_filters(params):
+    # Filtros estruturados da requisicao (form ou query string); category/author podem se repetir
+    filters = {
+        "category": [value for value in params.getlist("category") if value],
+        "author": [value for value in params.getlist("author") if value],
+        "min_rating": params.get("min_rating", type=float),
+        "max_rating": params.get("max_rating", type=float),
+    }
+    return {key: value for key, value in filters.items() if value not in (None, [])}
 
 @app_flask.route('/static/<path:path>')
 def serve_static(path):
@@ -13,31 +130,156 @@ def serve_static(path):
 
 @app_flask.route("/")
 def index():
-    return render_template("index.html", recommended_books=empty_df)
+    return render_template("index.html", recommended_books=HitList())
 
 @app_flask.route("/search", methods=["POST"])
 def search():
     query = request.form["query"]
     rank_type = request.form.get("rank_type", "bm25") 
+    # Mesma validacao do /api/search, mais a fusao, que so existe na interface
+    if rank_type not in RANK_TYPES and rank_type != "fusao_rrf":
+        return render_template("index.html", recommended_books=HitList(), query=query), 400
+
+    refresh_catalog()
+
+    budget_ms = request.form.get("budget_ms") or LATENCY_BUDGET_MS
+    filters = read_filters(request.form)
+    offset = max(0, min(request.form.get("offset", 0, type=int), MAX_OFFSET - 10))
+    # Alternativa escolhida pelo orcamento na primeira pagina, repetida nas demais (vazio numa busca nova)
+    ladder_step = request.form.get("ladder_step", type=int)
+
+    with span("search"):
+        if rank_type == "fusao_rrf":
+            recommended_books = app_vespa.search_fused(query, deadline=FUSION_DEADLINE, filters=filters, facets=True, fields=SHORT_FIELDS)
+        elif ladder_step is not None:
+            try:
+                recommended_books = app_vespa.search_page_at_step(query, rank_type, ladder_step, offset=offset, filters=filters, facets=True, fields=SHORT_FIELDS)
+            except ValueError:
+                return render_template("index.html", recommended_books=HitList(), rank_type=rank_type, query=query), 400
+        elif budget_ms:
+            recommended_books = app_vespa.search_within_budget(query, rank_type, budget=float(budget_ms) / 1000, offset=offset,
+                                                               filters=filters, facets=True, fields=SHORT_FIELDS)
+        else:
+            recommended_books = app_vespa.search_page(query, rank_type, offset=offset, filters=filters, facets=True, fields=SHORT_FIELDS)
+
+    with span("enrich"):
+        recommended_books = catalog.enrich(recommended_books, fields=CATALOG_FIELDS)
+
+    with span("render"):
+        return render_template("index.html", recommended_books=recommended_books, rank_type=rank_type, query=query,
+                               filters=filters, facets=recommended_books.attrs.get("facets", {}))
+
+def read_search_params(args):
+    # Parametros da busca da API: do cursor (paginas seguintes) ou da query string, validados do mesmo jeito
+    if args.get("cursor"):
+        return check_search_params(decode_cursor(args["cursor"]))
+    return check_search_params({
+        "query": args.get("query", "").strip(),
+        "rank_type": args.get("rank_type", "bm25"),
+        "offset": args.get("offset", 0, type=int),
+        "limit": args.get("limit", 10, type=int),
+        "filters": read_filters(args),
+        "facets": args.get("facets", "0") == "1",
+        "fields": "full" if args.get("fields") == "full" else "short",
+    })
+
+def is_number(value, kind=(int, float)):
+    return isinstance(value, kind) and not isinstance(value, bool) and value == value
+
+def check_search_params(params):
+    # O cursor volta do cliente e pode vir alterado ou cortado: tipos e limites conferidos como os da query string
+    query, rank_type, offset, limit = (params.get(key) for key in ("query", "rank_type", "offset", "limit"))
+    if not isinstance(query, str) or not isinstance(rank_type, str):
+        raise ValueError("query e rank_type devem ser texto")
+    if not is_number(offset, int) or not is_number(limit, int):
+        raise ValueError("offset e limit devem ser inteiros")
+    if not isinstance(params.get("facets"), bool) or params.get("fields") not in ("short", "full"):
+        raise ValueError("facets ou fields invalido")
+    limit = max(1, min(limit, PAGE_WINDOW))
+    return {
+        "query": query.strip(),
+        "rank_type": rank_type,
+        "offset": max(0, min(offset, MAX_OFFSET - limit)),
+        "limit": limit,
+        "filters": check_filters(params.get("filters")),
+        "facets": params["facets"],
+        "fields": params["fields"],
+    }
+
+def check_filters(filters):
+    # Mesmo formato de read_filters: listas de texto nao vazias para category/author e numeros para as notas
+    if not isinstance(filters, dict) or not set(filters) <= {"category", "author", "min_rating", "max_rating"}:
+        raise ValueError("filters invalido")
+    for key in ("category", "author"):
+        if key in filters and not (isinstance(filters[key], list) and filters[key] and all(isinstance(v, str) and v for v in filters[key])):
+            raise ValueError(f"filtro {key} invalido")
+    for key in ("min_rating", "max_rating"):
+        if key in filters and not is_number(filters[key]):
+            raise ValueError(f"filtro {key} invalido")
+    return filters
+
+@app_flask.route("/api/search")
+def api_search():
+    try:
+        params = read_search_params(request.args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, max_age=0, status=400)
+    if not params.get("query"):
+        return json_response({"error": "query e obrigatorio"}, max_age=0, status=400)
+    if params.get("rank_type") not in RANK_TYPES:
+        return json_response({"error": f"rank_type deve ser um de {sorted(RANK_TYPES)}"}, max_age=0, status=400)
+
+    refresh_catalog()
+    # Mesma busca + mesma versao do indice = mesma resposta: 304 sem tocar no engine
+    etag = make_etag(normalize_query(params["query"]), params["rank_type"], params["offset"], params["limit"],
+                     sorted(params["filters"].items()), params["facets"], params["fields"], catalog.version)
+    if not_modified(etag):
+        return not_modified_response(etag, API_MAX_AGE)
 
-    if rank_type == "bm25":
-        recommended_books = app_vespa.query_bm25(query)
-    elif rank_type == "bm25_semantic":
-        recommended_books = app_vespa.query_second_phase(query)
-    elif rank_type == "colbert_local":
-        recommended_books = app_vespa.query_colbert(query)
-    elif rank_type == "colbert_global":
-        recommended_books = app_vespa.query_colbert_global(query)
-    elif rank_type == "hibrido_colbert_local":
-        recommended_books = app_vespa.query_colbert_2phase(query)
-    elif rank_type == "hibrido_colbert_global":
-        recommended_books = app_vespa.query_colbert_2phase_global(query)
+    try:
+        with span("search"):
+            results = app_vespa.search_page(params["query"], params["rank_type"], offset=params["offset"], limit=params["limit"],
+                                            filters=params["filters"], facets=params["facets"], fields=SHORT_FIELDS)
+    except ValueError as e:
+        return json_response({"error": str(e)}, max_age=0, status=400)
+    detail = params["fields"] == "full"
+    with span("enrich"):
+        hits = catalog.enrich(results, fields=CATALOG_FIELDS if detail else ("thumbnail",))
+    fields = FULL_FIELDS + ("thumbnail", "relevance") if detail else SHORT_FIELDS + ("thumbnail", "relevance")
+    payload = {
+        "query": params["query"], "rank_type": params["rank_type"], "offset": params["offset"], "limit": params["limit"],
+        "hits": hits.to_dicts(fields),
+        "next_cursor": encode_cursor({**params, "offset": results.attrs["next_offset"]}) if results.attrs["has_more"] else None,
+    }
+    if params["facets"]:
+        payload["facets"] = results.attrs.get("facets", {})
+    with span("serialize"):
+        return json_response(payload, etag, API_MAX_AGE)
 
-    df = pd.read_csv("https://raw.githubusercontent.com/bernardovma/dados_livros/main/data.csv")
+@app_flask.route("/api/suggest")
+def suggest():
+    index = typeahead
+    limit = max(1, min(request.args.get("limit", index.max_suggestions, type=int), index.max_suggestions))
+    response = jsonify(index.suggest(request.args.get("q", ""), limit=limit))
+    response.cache_control.max_age = 60
+    return response
 
-    recommended_books = recommended_books.merge(df[['title', 'thumbnail']], on='title', how='left')
+@app_flask.route("/similar/<int:book_id>")
+def similar(book_id):
+    refresh_catalog()
+    table, store = neighbor_table, embedding_store
+    if book_id in table:
+        neighbor_ids, scores = table.similar(book_id, limit=10)
+        recommended_books = HitList(Hit(id=str(neighbor_id), relevance=score) for neighbor_id, score in zip(neighbor_ids, scores))
+        catalog.enrich(recommended_books, fields=("title", "authors", "categories") + CATALOG_FIELDS)
+    else:
+        pos = store.position(book_id)
+        vector = store.e5_vector(pos) if pos is not None else app_vespa.document_embedding(book_id)
+        if vector is None:
+            return render_template("index.html", recommended_books=HitList()), 404
+        recommended_books = catalog.enrich(app_vespa.query_similar(vector, exclude_id=book_id), fields=CATALOG_FIELDS)
 
-    return render_template("index.html", recommended_books=recommended_books, rank_type=rank_type)
+    return render_template("index.html", recommended_books=recommended_books, similar_to=catalog.get(book_id, "title"))
 
 if __name__ == "__main__":
     app_flask.run(debug=True, use_reloader = False)
\ No newline at end of file
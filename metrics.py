@@ -0,0 +1,280 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Limites (s) dos buckets de latencia, como os padroes do prometheus_client
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+HIT_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 400)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dump(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, dumps):
+        # Soma os valores de varios processos (ver Registry.enable_multiprocess)
+        values = {}
+        for dump in dumps:
+            for key, value in dump:
+                values[tuple(key)] = values.get(tuple(key), 0) + value
+        return values
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # Por combinacao de labels: [contagem por bucket (nao cumulativa, + o +Inf), soma]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def dump(self):
+        with self._lock:
+            return [[list(key), list(counts), total] for key, (counts, total) in self._values.items()]
+
+    def merge(self, dumps):
+        values = {}
+        for dump in dumps:
+            for key, counts, total in dump:
+                entry = values.setdefault(tuple(key), [[0] * (len(self.buckets) + 1), 0.0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+        return values
+
+    def render(self, values=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        items = sorted((key, (list(counts), total)) for key, (counts, total) in values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else format_value(bound)
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Metricas do processo. Com enable_multiprocess, cada processo (ex.: worker do gunicorn) grava o seu
+    estado num arquivo do diretorio compartilhado e render() soma todos, como o modo multiprocess do
+    prometheus_client: qualquer worker que atenda o scrape devolve os totais, e os contadores nao voltam.
+    O diretorio deve ser esvaziado antes de subir os workers; arquivos de workers encerrados continuam somados.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self.directory = None
+        self.dump_interval = 1.0
+        self._last_dump = 0.0
+        # Servidores com threads: um scrape (render) e o maybe_dump de uma requisicao nao gravam juntos
+        self._dump_lock = threading.Lock()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def enable_multiprocess(self, directory, dump_interval=1.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.dump_interval = dump_interval
+
+    def dump(self):
+        if self.directory is None:
+            return
+        with self._dump_lock:
+            self._write_dump()
+
+    def maybe_dump(self):
+        # Chamado a cada requisicao; grava no maximo uma vez por dump_interval, e nao espera se outra thread
+        # ja esta gravando
+        if self.directory is None or time.monotonic() - self._last_dump < self.dump_interval:
+            return
+        if not self._dump_lock.acquire(blocking=False):
+            return
+        try:
+            self._write_dump()
+        finally:
+            self._dump_lock.release()
+
+    def _write_dump(self):
+        # Escrita atomica do estado deste processo em <directory>/<pid>.json; o tmp leva o id da thread
+        self._last_dump = time.monotonic()
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({metric.name: metric.dump() for metric in self._metrics}, f)
+        os.replace(tmp_path, path)
+
+    def _load_dumps(self):
+        dumps = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    dumps.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return dumps
+
+    def render(self):
+        # Formato texto de exposicao do Prometheus (0.0.4)
+        lines = []
+        if self.directory is None:
+            for metric in self._metrics:
+                lines.extend(metric.render())
+        else:
+            self.dump()
+            dumps = self._load_dumps()
+            for metric in self._metrics:
+                lines.extend(metric.render(metric.merge(dump.get(metric.name, []) for dump in dumps)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.register(Histogram("bookrec_request_seconds", "Duracao das requisicoes HTTP", ["endpoint"]))
+STAGE_SECONDS = REGISTRY.register(Histogram("bookrec_stage_seconds", "Duracao de cada etapa de uma busca", ["stage"]))
+QUERY_SECONDS = REGISTRY.register(Histogram("bookrec_query_seconds", "Latencia das consultas ao engine vista pelo cliente", ["ranking"]))
+ENGINE_SECONDS = REGISTRY.register(Histogram("bookrec_engine_seconds", "Tempos reportados pelo engine (presentation.timing)", ["ranking", "phase"]))
+QUERY_HITS = REGISTRY.register(Histogram("bookrec_query_hits", "Hits retornados por consulta", ["ranking"], buckets=HIT_BUCKETS))
+QUERIES = REGISTRY.register(Counter("bookrec_queries_total", "Consultas enviadas ao engine", ["ranking"]))
+QUERY_ERRORS = REGISTRY.register(Counter("bookrec_query_errors_total", "Consultas ao engine que falharam", ["ranking"]))
+CACHE_REQUESTS = REGISTRY.register(Counter("bookrec_cache_requests_total", "Leituras dos caches do cliente (hit, miss ou coalesced)", ["cache", "result"]))
+
+
+class Trace:
+    """Etapas de uma requisicao (s, somadas quando a mesma etapa se repete) e as consultas feitas ao engine."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.queries = []
+        # Consultas da fusao registram de varias threads ao mesmo tempo (ver bind_trace)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_query(self, query):
+        with self._lock:
+            self.queries.append(query)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+
+_local = threading.local()
+
+
+def start_trace():
+    _local.trace = Trace()
+    return _local.trace
+
+
+def end_trace():
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    return trace
+
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+
+def bind_trace(fn):
+    # Leva o trace da requisicao para uma tarefa que roda em outra thread (ex.: perfis da fusao no executor)
+    trace = current_trace()
+
+    def run(*args, **kwargs):
+        previous = current_trace()
+        _local.trace = trace
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.trace = previous
+
+    return run
+
+
+@contextmanager
+def span(stage):
+    # Mede uma etapa: vai para o histograma por etapa e, se houver, para o trace da requisicao desta thread
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        trace = current_trace()
+        if trace is not None:
+            trace.add(stage, seconds)
+
+
+def record_query(ranking, elapsed, timing, hit_count, error):
+    # Listener do VespaApp (add_listener): uma chamada por consulta que foi ao engine
+    QUERIES.inc(ranking=ranking)
+    if error is not None:
+        QUERY_ERRORS.inc(ranking=ranking)
+    else:
+        QUERY_SECONDS.observe(elapsed, ranking=ranking)
+        QUERY_HITS.observe(hit_count, ranking=ranking)
+        for phase, seconds in timing.items():
+            if isinstance(seconds, (int, float)):
+                ENGINE_SECONDS.observe(seconds, ranking=ranking, phase=phase)
+    trace = current_trace()
+    if trace is not None:
+        trace.add_query({"ranking": ranking, "elapsed_ms": round(elapsed * 1000, 3), "timing": timing, "hits": hit_count, "error": error})
@@ -0,0 +1,149 @@
+import os
+import numpy as np
+from embeddings import current_version, save_version, unpack_colbert, version_dir
+
+NEIGHBORS_PATH = "neighbors"
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+
+class NeighborTable:
+    """Top-K livros mais semelhantes de cada livro, pre-calculados e mapeados em memoria.
+
+    neighbors.npy: (n, K) ids dos vizinhos; scores.npy: (n, K) cosseno e5 em float16.
+    ids.npy e hashes.npy identificam a versao de cada documento usada no calculo; colbert.npy registra se a
+    ordem dos vizinhos e a do MaxSim ColBERT (mudar o modo entre builds recalcula tudo).
+    """
+
+    def __init__(self, path=NEIGHBORS_PATH):
+        self.path = path
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.hashes = np.zeros(0, dtype="S40")
+        self.neighbors = np.zeros((0, 0), dtype=np.int64)
+        self.scores = np.zeros((0, 0), dtype=np.float16)
+        self._positions = {}
+        self.colbert = None
+        self.version = None
+        self.load()
+
+    def load(self):
+        # Mesma troca atomica por versao do DocumentEmbeddingStore
+        version = current_version(self.path)
+        directory = version_dir(self.path, version)
+        if not os.path.exists(os.path.join(directory, "ids.npy")):
+            return False
+        self.ids = np.load(os.path.join(directory, "ids.npy"))
+        self.hashes = np.load(os.path.join(directory, "hashes.npy"))
+        self.neighbors = np.load(os.path.join(directory, "neighbors.npy"), mmap_mode="r")
+        self.scores = np.load(os.path.join(directory, "scores.npy"), mmap_mode="r")
+        self._positions = {int(doc_id): pos for pos, doc_id in enumerate(self.ids)}
+        # None em tabelas sem o arquivo (gravadas antes dele): modo desconhecido, o proximo build recalcula tudo
+        colbert_path = os.path.join(directory, "colbert.npy")
+        self.colbert = bool(np.load(colbert_path)) if os.path.exists(colbert_path) else None
+        self.version = version
+        return True
+
+    def stale(self):
+        # Outro processo gravou uma versao nova (ex.: admin.py); quem serve troca por uma instancia nova
+        return current_version(self.path) != self.version
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, doc_id):
+        return int(doc_id) in self._positions
+
+    def similar(self, doc_id, limit=10):
+        pos = self._positions.get(int(doc_id))
+        if pos is None:
+            return [], []
+        return self.neighbors[pos, :limit].tolist(), self.scores[pos, :limit].astype(np.float32).tolist()
+
+    def build(self, store, k=20, colbert=False, batch_size=1024):
+        # Incremental: so recalcula as linhas de documentos novos/alterados ou que tinham como vizinho um
+        # documento alterado/removido; nas demais, os documentos alterados entram se superarem o K-esimo vizinho
+        vectors = normalize_rows(store.e5_matrix())
+        ids = np.asarray(store.ids, dtype=np.int64)
+        hashes = np.asarray(store.hashes)
+        k = min(k, max(len(ids) - 1, 0))
+        old = {int(doc_id): pos for pos, doc_id in enumerate(self.ids)}
+        reusable = len(self.ids) > 0 and self.neighbors.shape[1] == k and self.colbert == colbert
+
+        changed = np.array([old.get(int(doc_id)) is None or self.hashes[old[int(doc_id)]] != doc_hash
+                            for doc_id, doc_hash in zip(ids, hashes)], dtype=bool)
+        neighbors = np.zeros((len(ids), k), dtype=np.int64)
+        scores = np.zeros((len(ids), k), dtype=np.float32)
+        recompute = changed.copy() if reusable else np.ones(len(ids), dtype=bool)
+        touched = recompute.copy()
+
+        if reusable:
+            current = set(ids.tolist())
+            stale = set(ids[changed].tolist()) | (set(self.ids.tolist()) - current)
+            for pos, doc_id in enumerate(ids):
+                if recompute[pos]:
+                    continue
+                row = old[int(doc_id)]
+                neighbors[pos] = self.neighbors[row]
+                scores[pos] = self.scores[row]
+                if stale.intersection(neighbors[pos].tolist()):
+                    recompute[pos] = True
+            # Documentos alterados como candidatos para as linhas mantidas
+            changed_positions = np.flatnonzero(changed)
+            kept = np.flatnonzero(~recompute)
+            if len(changed_positions) and len(kept) and k:
+                for start in range(0, len(kept), batch_size):
+                    rows = kept[start:start + batch_size]
+                    candidate_scores = vectors[rows] @ vectors[changed_positions].T
+                    merged_ids = np.concatenate([neighbors[rows], np.broadcast_to(ids[changed_positions], candidate_scores.shape)], axis=1)
+                    merged_scores = np.concatenate([scores[rows], candidate_scores], axis=1)
+                    merged_scores[merged_ids == ids[rows][:, None]] = -np.inf
+                    top = np.argsort(-merged_scores, axis=1, kind="stable")[:, :k]
+                    # So as linhas em que entrou um documento alterado sao regravadas (e reordenadas pelo ColBERT
+                    # abaixo); nas demais fica a ordem gravada, que com colbert=True nao e a do e5
+                    entered = (top >= k).any(axis=1)
+                    touched[rows] = entered
+                    rows, top = rows[entered], top[entered]
+                    neighbors[rows] = np.take_along_axis(merged_ids[entered], top, axis=1)
+                    scores[rows] = np.take_along_axis(merged_scores[entered], top, axis=1)
+
+        rows_to_compute = np.flatnonzero(recompute)
+        touched |= recompute
+        for start in range(0, len(rows_to_compute), batch_size):
+            rows = rows_to_compute[start:start + batch_size]
+            similarity = vectors[rows] @ vectors.T
+            similarity[np.arange(len(rows)), rows] = -np.inf
+            top = np.argpartition(-similarity, k - 1, axis=1)[:, :k] if k else np.zeros((len(rows), 0), dtype=np.int64)
+            top_scores = np.take_along_axis(similarity, top, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind="stable")
+            neighbors[rows] = ids[np.take_along_axis(top, order, axis=1)]
+            scores[rows] = np.take_along_axis(top_scores, order, axis=1)
+
+        if colbert:
+            positions = {int(doc_id): pos for pos, doc_id in enumerate(ids)}
+            for pos in np.flatnonzero(touched):
+                neighbors[pos], scores[pos] = self._colbert_rerank(store, pos, neighbors[pos], scores[pos], positions)
+
+        save_version(self.path, [
+            ("neighbors.npy", neighbors),
+            ("scores.npy", scores.astype(np.float16)),
+            ("hashes.npy", hashes),
+            ("ids.npy", ids),
+            ("colbert.npy", np.array(colbert)),
+        ])
+        self.load()
+        return {"recomputed": int(recompute.sum()), "kept": int((~recompute).sum())}
+
+    def _colbert_rerank(self, store, pos, neighbor_ids, neighbor_scores, positions):
+        # Reordena os vizinhos pelo MaxSim entre os tokens ColBERT dos dois livros (normalizado pelo numero de tokens)
+        source = unpack_colbert(store.colbert_tokens(pos))
+        if len(source) == 0:
+            return neighbor_ids, neighbor_scores
+        max_sims = []
+        for neighbor_id in neighbor_ids:
+            target = unpack_colbert(store.colbert_tokens(positions[int(neighbor_id)]))
+            max_sims.append((source @ target.T).max(axis=1).mean() if len(target) else 0.0)
+        order = np.argsort(-np.array(max_sims), kind="stable")
+        return neighbor_ids[order], neighbor_scores[order]
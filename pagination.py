@@ -0,0 +1,20 @@
+import base64
+import binascii
+import json
+
+
+def encode_cursor(params):
+    # Token opaco com tudo o que define a proxima pagina (consulta, ranking, filtros, offset, ...)
+    data = json.dumps(params, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(token):
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        params = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("cursor invalido") from e
+    if not isinstance(params, dict):
+        raise ValueError("cursor invalido")
+    return params
@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from metrics import CACHE_REQUESTS
+
+
+def normalize_query(query):
+    # O Vespa ja normaliza caixa e espacos na busca; consultas que diferem so nisso compartilham a entrada
+    return " ".join(query.lower().split())
+
+
+class QueryCache:
+    """Cache LRU com TTL para resultados de consultas, com deduplicacao de consultas em andamento.
+
+    Com name, hits/misses/coalesced tambem vao para bookrec_cache_requests_total (/metrics).
+    """
+
+    def __init__(self, max_size=1024, ttl=300.0, name=None):
+        self.max_size = max_size
+        self.name = name
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_compute(self, key, compute, timeout=None):
+        # timeout (s): o chamador tem um prazo (orcamento de latencia). Ele le o cache e espera no maximo timeout
+        # por uma consulta igual em andamento, mas a sua propria nao e compartilhada nem guardada: estourar o
+        # prazo nao deve falhar para quem nao tem prazo, e um resultado parcial (timeout do Vespa) nao vai para o cache
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._count("hit")
+                return entry[1]
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                self._count("coalesced")
+                owner = False
+            elif timeout is not None:
+                self.misses += 1
+                self._count("miss")
+                owner = None
+            else:
+                # Primeira requisicao para a chave: esta thread consulta o backend e as demais esperam
+                future = Future()
+                self._in_flight[key] = future
+                self.misses += 1
+                self._count("miss")
+                owner = True
+                generation = self._generation
+
+        if owner is None:
+            return compute()
+        if not owner:
+            return future.result(timeout=timeout)
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._in_flight.pop(key, None)
+            # Um feed terminado durante a consulta invalida o resultado: nao guarda
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def _count(self, result):
+        if self.name is not None:
+            CACHE_REQUESTS.inc(cache=self.name, result=result)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
@@ -0,0 +1,34 @@
+import requests
+from requests.adapters import HTTPAdapter
+from vespa.io import VespaQueryResponse
+
+
+class QueryPool:
+    """Pool de conexoes HTTP persistente e thread-safe para consultas ao Vespa."""
+
+    def __init__(self, app, pool_size=25, timeout=10.0, connect_timeout=3.0, keep_alive=True, retries=0):
+        self.url = app.search_end_point
+        self.timeout = (connect_timeout, timeout)
+        self.session = requests.Session()
+        # pool_block: com todas as conexoes em uso a requisicao espera uma livre em vez de abrir outra
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retries)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+        if getattr(app, "cert", None):
+            self.session.cert = (app.cert, app.key) if getattr(app, "key", None) else app.cert
+
+    def query(self, body, timeout=None):
+        # timeout (s): limite de leitura so desta requisicao (ex.: o que resta do orcamento de latencia)
+        timeout = self.timeout if timeout is None else (min(self.timeout[0], timeout), timeout)
+        response = self.session.post(self.url, json=body, timeout=timeout)
+        try:
+            json = response.json()
+        except ValueError:
+            json = {"root": {"errors": [{"message": response.text}]}}
+        return VespaQueryResponse(json=json, status_code=response.status_code, url=str(response.url))
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,68 @@
+import pandas as pd
+
+# Campos que um resultado pode ter: os do Vespa (conforme a projecao), os completados pelo Catalog e o score
+HIT_FIELDS = ("id", "title", "authors", "description", "categories", "average_rating", "thumbnail", "relevance")
+
+
+class Hit:
+    """Um livro do resultado de uma busca; campos fora da projecao ficam None."""
+
+    __slots__ = HIT_FIELDS
+
+    def __init__(self, **fields):
+        for name in HIT_FIELDS:
+            setattr(self, name, fields.get(name))
+
+    def __getitem__(self, name):
+        # Mesmo acesso de uma linha de DataFrame: book['title']
+        if name not in HIT_FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None) if name in HIT_FIELDS else None
+        return default if value is None else value
+
+    def copy(self):
+        return Hit(**{name: getattr(self, name) for name in HIT_FIELDS})
+
+    def as_dict(self, fields=HIT_FIELDS):
+        return {name: getattr(self, name) for name in fields}
+
+    def __repr__(self):
+        return f"Hit(id={self.id!r}, title={self.title!r})"
+
+
+class HitList(list):
+    """Lista de Hit em ordem de ranking, com metadados da busca em attrs (facetas, perfil usado, ...).
+
+    results['title'] devolve a coluna como lista, como no DataFrame que as consultas retornavam antes;
+    to_df() converte quando uma tabela for mesmo necessaria (notebooks).
+    """
+
+    def __init__(self, hits=(), attrs=None):
+        super().__init__(hits)
+        self.attrs = dict(attrs or {})
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return [getattr(hit, key) for hit in self]
+        if isinstance(key, slice):
+            return HitList(super().__getitem__(key), self.attrs)
+        return super().__getitem__(key)
+
+    def copy(self):
+        # Copia os Hit: quem chama (ex.: Catalog.enrich) preenche campos, e a entrada do cache deve ficar intacta
+        return HitList([hit.copy() for hit in self], self.attrs)
+
+    def to_dicts(self, fields=HIT_FIELDS):
+        return [hit.as_dict(fields) for hit in self]
+
+    def to_df(self, fields=None):
+        fields = list(fields or [name for name in HIT_FIELDS if any(getattr(hit, name) is not None for hit in self)])
+        df = pd.DataFrame(self.to_dicts(fields), columns=fields)
+        df.attrs.update(self.attrs)
+        return df
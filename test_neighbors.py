@@ -0,0 +1,64 @@
+import numpy as np
+from embeddings import pack_colbert
+from neighbors import NeighborTable
+
+
+class SyntheticStore:
+    """Minimo do DocumentEmbeddingStore usado por NeighborTable.build, com vetores aleatorios."""
+
+    def __init__(self, n=40, seed=0):
+        rng = np.random.default_rng(seed)
+        self.rng = rng
+        self.ids = np.arange(1, n + 1, dtype=np.int64)
+        self.hashes = np.array([f"h{doc_id}".encode() for doc_id in self.ids], dtype="S40")
+        self.vectors = rng.normal(size=(n, 384)).astype(np.float32)
+        self.tokens = [pack_colbert(rng.normal(size=(8, 128))) for _ in range(n)]
+
+    def change(self, pos):
+        self.hashes[pos] = f"h{self.ids[pos]}-{self.rng.integers(1 << 30)}".encode()
+        self.vectors[pos] = self.rng.normal(size=384)
+        self.tokens[pos] = pack_colbert(self.rng.normal(size=(8, 128)))
+
+    def e5_matrix(self):
+        return self.vectors
+
+    def colbert_tokens(self, pos):
+        return self.tokens[pos]
+
+
+def assert_colbert_order(table, store):
+    positions = {int(doc_id): pos for pos, doc_id in enumerate(store.ids)}
+    for pos in range(len(store.ids)):
+        neighbors = np.asarray(table.neighbors[pos])
+        expected, _ = table._colbert_rerank(store, pos, neighbors, np.asarray(table.scores[pos]), positions)
+        assert neighbors.tolist() == expected.tolist()
+
+
+def test_incremental_builds_keep_colbert_order(tmp_path):
+    store = SyntheticStore()
+    table = NeighborTable(str(tmp_path / "neighbors"))
+    table.build(store, k=5, colbert=True)
+    assert_colbert_order(table, store)
+
+    for pos in (3, 17):
+        store.change(pos)
+    report = table.build(store, k=5, colbert=True)
+    assert report["kept"] > 0
+    assert_colbert_order(table, store)
+
+    store.change(25)
+    table.build(store, k=5, colbert=True)
+    assert_colbert_order(table, store)
+
+
+def test_changing_the_mode_rebuilds_everything(tmp_path):
+    store = SyntheticStore(seed=1)
+    table = NeighborTable(str(tmp_path / "neighbors"))
+    table.build(store, k=5, colbert=False)
+    assert table.colbert is False
+
+    report = table.build(store, k=5, colbert=True)
+    assert report == {"recomputed": len(store.ids), "kept": 0}
+    assert table.colbert is True
+    assert_colbert_order(table, store)
+    assert NeighborTable(table.path).colbert is True
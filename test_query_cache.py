@@ -0,0 +1,103 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import pytest
+from query_cache import QueryCache
+
+
+def slow(value, started=None, release=None, calls=None):
+    def compute():
+        if calls is not None:
+            calls.append(value)
+        if started is not None:
+            started.set()
+        if release is not None:
+            release.wait(5)
+        return value
+    return compute
+
+
+def test_hit_after_compute():
+    cache = QueryCache()
+    calls = []
+    assert cache.get_or_compute("k", slow(1, calls=calls)) == 1
+    assert cache.get_or_compute("k", slow(2, calls=calls)) == 1
+    assert calls == [1]
+    assert cache.hits == 1
+
+
+def test_concurrent_misses_are_coalesced():
+    cache = QueryCache()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        owner = executor.submit(cache.get_or_compute, "k", slow(1, started, release, calls))
+        started.wait(5)
+        waiters = [executor.submit(cache.get_or_compute, "k", slow(2, calls=calls)) for _ in range(3)]
+        while cache.coalesced < 3:
+            time.sleep(0.01)
+        release.set()
+        assert owner.result() == 1
+        assert [waiter.result() for waiter in waiters] == [1, 1, 1]
+    assert calls == [1]
+
+
+def test_exception_reaches_waiters_and_is_not_cached():
+    cache = QueryCache()
+    started, release = threading.Event(), threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("backend")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        owner = executor.submit(cache.get_or_compute, "k", failing)
+        started.wait(5)
+        waiter = executor.submit(cache.get_or_compute, "k", slow(2))
+        while cache.coalesced < 1:
+            time.sleep(0.01)
+        release.set()
+        with pytest.raises(RuntimeError):
+            owner.result()
+        with pytest.raises(RuntimeError):
+            waiter.result()
+    assert cache.get_or_compute("k", slow(3)) == 3
+
+
+def test_timeout_call_is_neither_shared_nor_cached():
+    cache = QueryCache()
+    started, release = threading.Event(), threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        budgeted = executor.submit(cache.get_or_compute, "k", slow(1, started, release), timeout=1.0)
+        started.wait(5)
+        # Sem prazo: nao espera a consulta com prazo, faz a sua
+        assert cache.get_or_compute("k", slow(2)) == 2
+        release.set()
+        assert budgeted.result() == 1
+    assert cache.get_or_compute("k", slow(3)) == 2
+
+
+def test_timeout_waiter_gives_up_at_its_deadline():
+    cache = QueryCache()
+    started, release = threading.Event(), threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        owner = executor.submit(cache.get_or_compute, "k", slow(1, started, release))
+        started.wait(5)
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            cache.get_or_compute("k", slow(2), timeout=0.05)
+        assert time.monotonic() - start < 1.0
+        release.set()
+        assert owner.result() == 1
+
+
+def test_invalidate_during_compute_skips_store():
+    cache = QueryCache()
+
+    def compute():
+        cache.invalidate()
+        return 1
+
+    assert cache.get_or_compute("k", compute) == 1
+    assert cache.get_or_compute("k", slow(2)) == 2
@@ -0,0 +1,116 @@
+import heapq
+import re
+import unicodedata
+from bisect import bisect_left
+import numpy as np
+
+WHITESPACE = re.compile(r"\s+")
+# Prefixos que casam com mais chaves que isso tem as sugestoes pre-calculadas; os demais sao
+# ranqueados na hora, sobre no maximo PRECOMPUTE_ABOVE chaves
+PRECOMPUTE_ABOVE = 64
+MAX_SUGGESTIONS = 10
+
+
+def normalize_text(text):
+    # Sem acentos, casefold e espacos colapsados: "Émile  Zola" -> "emile zola"
+    decomposed = unicodedata.normalize("NFKD", str(text))
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return WHITESPACE.sub(" ", stripped.casefold()).strip()
+
+
+class TypeaheadIndex:
+    """Indice de prefixos em memoria sobre titulos e autores do catalogo, para o autocomplete.
+
+    As chaves normalizadas (titulo inteiro, titulo a partir de cada palavra e cada autor) ficam num
+    array ordenado; um prefixo vira um intervalo [lo, hi) achado com bisect. Cada chave aponta para uma
+    sugestao (titulo ou autor) com sua popularidade (ratings_count, somado entre os livros do autor).
+    """
+
+    def __init__(self, ids, titles, authors, popularity, max_suggestions=MAX_SUGGESTIONS):
+        self.max_suggestions = max_suggestions
+        labels, kinds, book_ids, scores = [], [], [], []
+        suggestion_of = {}
+
+        def suggestion(kind, label, book_id, score):
+            key = (kind, normalize_text(label))
+            slot = suggestion_of.get(key)
+            if slot is None:
+                slot = suggestion_of[key] = len(labels)
+                labels.append(label)
+                kinds.append(kind)
+                book_ids.append(book_id)
+                scores.append(0.0)
+            if kind == "author":
+                scores[slot] += score
+            elif score > scores[slot]:
+                # Titulos repetidos (edicoes diferentes): fica o livro mais popular
+                scores[slot] = score
+                book_ids[slot] = book_id
+            return slot
+
+        entries = set()
+        for book_id, title, book_authors, score in zip(ids, titles, authors, popularity):
+            title = str(title).strip()
+            if title:
+                slot = suggestion("title", title, int(book_id), score)
+                words = normalize_text(title).split(" ")
+                for start in range(len(words)):
+                    entries.add((" ".join(words[start:]), slot))
+            for author in str(book_authors).split(";"):
+                author = author.strip()
+                if author:
+                    slot = suggestion("author", author, None, score)
+                    words = normalize_text(author).split(" ")
+                    # Autor tambem pelo sobrenome: "tolkien" -> "J. R. R. Tolkien"
+                    for start in range(len(words)):
+                        entries.add((" ".join(words[start:]), slot))
+
+        entries = sorted(entries)
+        self.keys = [key for key, _ in entries]
+        self.slots = np.array([slot for _, slot in entries], dtype=np.int32)
+        self.labels = labels
+        self.kinds = kinds
+        self.book_ids = book_ids
+        self.scores = scores
+
+        self._precomputed = {}
+        pending = sorted({key[:1] for key in self.keys if key})
+        while pending:
+            children = set()
+            for prefix in pending:
+                lo, hi = self._range(prefix)
+                if hi - lo <= PRECOMPUTE_ABOVE:
+                    continue
+                self._precomputed[prefix] = self._rank(prefix)
+                children.update(key[:len(prefix) + 1] for key in self.keys[lo:hi] if len(key) > len(prefix))
+            pending = children
+
+    @classmethod
+    def from_catalog(cls, catalog, **options):
+        popularity = np.nan_to_num(np.array([float(v) if v != "" else 0.0 for v in catalog.column("ratings_count")]))
+        return cls(catalog.column("id"), catalog.column("title"), catalog.column("authors"), popularity, **options)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _range(self, prefix):
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + "\U0010ffff", lo)
+        return lo, hi
+
+    def _rank(self, prefix):
+        lo, hi = self._range(prefix)
+        slots = set(self.slots[lo:hi].tolist())
+        return heapq.nlargest(self.max_suggestions, slots, key=lambda slot: (self.scores[slot], -slot))
+
+    def suggest(self, text, limit=MAX_SUGGESTIONS):
+        prefix = normalize_text(text)
+        if not prefix:
+            return []
+        slots = self._precomputed.get(prefix)
+        if slots is None:
+            slots = self._rank(prefix)
+        return [
+            {"label": self.labels[slot], "type": self.kinds[slot], "id": self.book_ids[slot]}
+            for slot in slots[:limit]
+        ]